@@ -39,8 +39,9 @@ class Controller:
                  controller_config_file_name: str):
         # self.config_file_name = controller_config_file_name
         self.periph_devices = periph_devices
-        self.well_tank_dev = self.periph_devices['well_and_tank']
-        self.greenhouse_dev = self.periph_devices['greenhouse']
+        # None if the device is missing (e.g. its type is not supported). Its automation is not run then
+        self.well_tank_dev = self.periph_devices.get('well_and_tank', None)
+        self.greenhouse_dev = self.periph_devices.get('greenhouse', None)
         # Telling devices to send notification to this controller then requesting their states
         # Their responses will be handled in a different function
         for curr_dev in self.periph_devices.values():
@@ -61,43 +62,85 @@ class Controller:
 
     def handle_user_command(self, command_text):
         """
-        Parses user command and executes it if it is valid
+        Parses user commands and executes them if all of them are valid. If any of the commands is invalid, none of them
+        is executed. Commands for the same device are sent to it in one write. If a device is offline, its commands are
+        not executed, the other devices' ones are.
+        Acceptable command_text format - either one command or an array of them:
+        { "target": "well_and_tank", "parameter": "pump", "command": "turn_off" }
+        [
+            { "target": "greenhouse", "parameter": "window", "command": "Close" },
+            { "target": "greenhouse", "parameter": "lights", "command": "turn_on" }
+        ]
         :param command_text: raw user-formed string
-        :return:
+        :return: (valid, errors). valid is False if the commands have been rejected as invalid, none of them has been
+        executed then. errors is a list of error messages (invalid commands or offline devices). Empty if all the
+        commands have been executed
         """
         try:
-            command = json.loads(command_text)
+            commands = json.loads(command_text)
         except json.JSONDecodeError:
             self.error_callback('Could not parse user command')
-            return
+            return False, ['Could not parse user command']
+        if not isinstance(commands, list):
+            commands = [commands]
+
+        errors = []
+        for curr_command in commands:
+            curr_error = self.__validate_user_command(curr_command)
+            if curr_error is not None:
+                self.error_callback(curr_error)
+                errors.append(curr_error)
+        if errors:
+            return False, errors
+
+        # Grouping commands by device, keeping their order
+        devices_commands = {}
+        for curr_command in commands:
+            devices_commands.setdefault(curr_command['target'], []).append((curr_command['parameter'],
+                                                                            curr_command['command']))
+        for curr_target, curr_commands in devices_commands.items():
+            if not self.periph_devices[curr_target].send_commands(curr_commands):
+                curr_error = 'Device {} is offline, its commands have not been executed'.format(curr_target)
+                self.error_callback(curr_error)
+                errors.append(curr_error)
+            # No need to call handle_updates as there are no updates yet - the device has not confirmed that its
+            # state has changed
+        return True, errors
 
+    def __validate_user_command(self, command):
+        """
+        :param command: One parsed user command (see handle_user_command)
+        :return: Error message or None if the command is valid
+        """
+        if not isinstance(command, dict):
+            return 'Invalid command format: {}'.format(command)
         target = command.get('target', None)
         parameter = command.get('parameter', None)
         command = command.get('command', None)
+        if not (isinstance(target, str) and isinstance(parameter, str) and isinstance(command, str)):
+            return 'Invalid command format: target, parameter and command must be strings'
         if target == 'controller':
-            pass
-        elif target == 'well_and_tank':
+            return 'Controller commands are not supported'
+        device = self.periph_devices.get(target, None)
+        if device is None:
+            return 'No such device: {}'.format(target)
+        if target == 'well_and_tank':
             # if the pump is controlled automatically, user command has no effect
             with self.config_lock:
                 is_auto = self.config['pump_auto_control']
             if is_auto:
-                self.error_callback('Attempted to execute a manual command on an automated parameter')
-                return
-            if parameter == 'pump':
-                # Find parameter description
-                for curr_param in self.well_tank_dev.description['parameters']:
-                    if curr_param['name'] == 'pump':
-                        break
-                if (command != curr_param['commands'][0]) and \
-                        (command != curr_param['commands'][1]):
-                    self.error_callback('Invalid value {}:{}:{}'.format(target, parameter, command))
-                    return
-                self.well_tank_dev.send_command(parameter, command)
-                # No need to call handle_updates as there are no updates yet - the device has not confirmed that its
-                # state has changed
-            else:
-                self.error_callback("Cannot control {}'s parameter {}".format(target, parameter))
-                return
+                return 'Attempted to execute a manual command on an automated parameter'
+        # Find parameter description
+        for curr_param in device.description['parameters']:
+            if curr_param['name'] == parameter:
+                break
+        else:
+            return "Cannot control {}'s parameter {}".format(target, parameter)
+        if not curr_param['controllable']:
+            return "Cannot control {}'s parameter {}".format(target, parameter)
+        if command not in curr_param['commands']:
+            return 'Invalid value {}:{}:{}'.format(target, parameter, command)
+        return None
 
     def handle_device_parameter_update(self, device: SimplePeriphDev, parameter, value):
         """
@@ -148,6 +191,8 @@ class Controller:
         Analyzes the current parameters of the system and controller config and manages pump according to it
         :return:
         """
+        if self.well_tank_dev is None:
+            return
         with self.config_lock:
             if self.config['pump_auto_control'] == False:
                 # Controller doesn't need to do anything about the pump as it is in manual control mode
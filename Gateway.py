@@ -0,0 +1,421 @@
+from http.client import HTTPConnection, HTTPException
+from queue import LifoQueue, Empty, Full
+from threading import Lock, Thread
+from contextlib import contextmanager
+from HttpServer import CustomHTTPServer
+from jinja2 import Template
+import logging
+import json
+import copy
+import time
+import os
+
+# Separates site name from device name in namespaced device names. E.g. 'plot_1/greenhouse'
+site_separator = '/'
+
+
+def namespaced_name(site_name, device_name):
+    return '{}{}{}'.format(site_name, site_separator, device_name)
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class UpstreamConnectionPool:
+    """
+    Pool of persistent HTTP connections to one upstream controller (CustomHTTPServer).
+    Idle connections are kept open and reused by subsequent requests so that a TCP handshake is only performed when
+    there is no idle connection available. Safe for use by multiple threads.
+    """
+
+    def __init__(self, host, port, timeout=10, max_idle_connections=4):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        # Most recently used connection goes first. It is the most likely one to be still alive
+        self.__idle_connections = LifoQueue(maxsize=max_idle_connections)
+
+    @contextmanager
+    def connection(self):
+        """
+        Takes an idle connection from the pool (or opens a new one) and gives it back when done.
+        If an exception is raised while the connection is in use, it is closed instead of being returned to the pool
+        """
+        try:
+            conn = self.__idle_connections.get_nowait()
+        except Empty:
+            conn = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        try:
+            self.__idle_connections.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def request(self, method, path, body=None, headers=None, idempotent=None):
+        """
+        Performs an HTTP request. If a reused connection turns out to be closed by the upstream (e.g. idle timeout),
+        an idempotent request is retried once on a new connection. A non-idempotent one (e.g. a user command) is not,
+        as the upstream may have executed it before the connection was lost.
+        :param idempotent: Whether the request may be performed twice. By default only GET requests are
+        :return: (status, response body bytes)
+        """
+        if idempotent is None:
+            idempotent = method == 'GET'
+        for attempt in range(2):
+            try:
+                with self.connection() as conn:
+                    reused = conn.sock is not None
+                    conn.request(method, path, body, headers or {})
+                    response = conn.getresponse()
+                    data = response.read()
+                return response.status, data
+            except (ConnectionError, HTTPException):
+                if not idempotent or not reused or attempt != 0:
+                    raise
+
+    def close(self):
+        while True:
+            try:
+                self.__idle_connections.get_nowait().close()
+            except Empty:
+                break
+
+
+class UpstreamSite:
+    """
+    One upstream controller. Keeps a copy of its state (see CustomHTTPServer.get_full_state) up to date by
+    long-polling its '/updates' and forwards every update, namespaced, to the gateway.
+    self.devices format:
+    {
+        "well_and_tank": {
+            "name": "well_and_tank",
+            "online": true,
+            "parameters": {
+                "pump": "off",
+                ...
+            },
+            "stale_times": {
+                "tank": 1538239203.52
+            }
+        },
+        ...
+    }
+    "stale_times" holds the times stale parameters' values are from (see '/initial_data' in HttpServer.py). They are
+    converted back to ages when the state is sent to the clients
+    """
+
+    def __init__(self, name, host, port, gateway, poll_timeout=300):
+        self.name = name
+        self.gateway = gateway
+        self.pool = UpstreamConnectionPool(host, port)
+        # Long-poll requests wait for an upstream update, so they need their own connection with a longer timeout
+        self.__poll_conn = UpstreamConnectionPool(host, port, timeout=poll_timeout, max_idle_connections=1)
+        self.online = False
+        # Peripheral devices descriptions of the site. None until fetched
+        self.descriptions = None
+        self.state_lock = Lock()
+        self.devices = {}
+        self.controller_config = {}
+        self.__last_update_time = 0.0
+
+    def start(self):
+        thread = Thread(target=self.__run, name='Upstream {}'.format(self.name), daemon=True)
+        thread.start()
+
+    def __run(self):
+        """
+        Continuously keeps the site's state up to date. Reconnects when the site goes offline
+        :return:
+        """
+        while True:
+            try:
+                if self.descriptions is None:
+                    self.__fetch_descriptions()
+                self.__fetch_initial_data()
+                self.__poll_updates()
+            # KeyError, TypeError: malformed response. The site may be running a different version. The thread must
+            # keep running anyway
+            except (OSError, HTTPException, UpstreamError, ValueError, KeyError, TypeError, AttributeError) as e:
+                if self.online:
+                    logging.warning('Site %s has gone offline (%s). Trying to reconnect', self.name, e)
+                    self.__handle_gone_offline()
+                self.__poll_conn.close()
+                self.pool.close()
+            time.sleep(self.gateway.retry_connection_delay)
+
+    def __get_json(self, pool, method, path, body=None, idempotent=None):
+        status, data = pool.request(method, path, body, idempotent=idempotent)
+        if status != 200:
+            raise UpstreamError('"{} {}" responded {}'.format(method, path, status))
+        return json.loads(str(data, self.gateway.encoding))
+
+    def __fetch_descriptions(self):
+        descriptions = self.__get_json(self.pool, 'GET', '/descriptions')
+        with self.state_lock:
+            self.descriptions = descriptions
+        self.gateway.render_main_pages()
+
+    def __fetch_initial_data(self):
+        initial_data = self.__get_json(self.pool, 'GET', '/initial_data')
+        with self.state_lock:
+            self.__last_update_time = initial_data['time']
+            self.devices = {curr_dev['name']: curr_dev for curr_dev in initial_data['devices']}
+            # Stale parameters' ages are only valid at the time of the response. Keeping the times they are from
+            now = time.time()
+            for curr_dev in self.devices.values():
+                curr_dev['stale_times'] = {curr_param: now - curr_age
+                                           for curr_param, curr_age in curr_dev.pop('stale', {}).items()}
+            self.controller_config = initial_data['controller_config']
+            self.online = True
+            # Updates the clients about everything as they may have missed something while the site was offline
+            update_data = self.__namespaced_update({
+                'devices': list(self.devices.values()),
+                'controller_config': self.controller_config
+            })
+        logging.info('Site %s is online', self.name)
+        self.gateway.parameter_update_handler(update_data)
+
+    def __poll_updates(self):
+        """
+        Long-polls the site's updates. Never returns, only raises when the connection is lost
+        :return:
+        """
+        while True:
+            try:
+                # Polling does not change anything on the site, so it may be retried
+                update_data = self.__get_json(self.__poll_conn, 'POST', '/updates', str(self.__last_update_time),
+                                              idempotent=True)
+            except TimeoutError:
+                # No updates for a long time. Polling again on a new connection. If the site has actually gone
+                # offline, connecting will fail
+                self.__poll_conn.close()
+                continue
+            with self.state_lock:
+                self.__last_update_time = update_data['time']
+                self.__apply_update(update_data)
+                update_data = self.__namespaced_update(update_data)
+            self.gateway.parameter_update_handler(update_data)
+
+    def __apply_update(self, update_data):
+        """
+        Applies an update to the copy of the site's state. self.state_lock must be acquired
+        :return:
+        """
+        for curr_dev_update in update_data['devices']:
+            curr_dev = self.devices.setdefault(curr_dev_update['name'],
+                                               {'name': curr_dev_update['name'], 'online': True, 'parameters': {}})
+            curr_dev['parameters'].update(curr_dev_update.get('parameters', {}))
+            # Live values replace stale ones
+            for curr_param in curr_dev_update.get('parameters', {}):
+                curr_dev.get('stale_times', {}).pop(curr_param, None)
+            if 'online' in curr_dev_update:
+                curr_dev['online'] = curr_dev_update['online']
+        self.controller_config.update(update_data.get('controller_config', {}))
+
+    def __handle_gone_offline(self):
+        with self.state_lock:
+            self.online = False
+            for curr_dev in self.devices.values():
+                curr_dev['online'] = False
+            update_data = self.__namespaced_update({
+                'devices': [{'name': curr_dev_name, 'online': False, 'parameters': {}}
+                            for curr_dev_name in self.devices],
+                'controller_config': {}
+            })
+        self.gateway.parameter_update_handler(update_data)
+
+    def __namespaced_update(self, update_data):
+        """
+        Converts site's update data (or full state) to the gateway's format: devices' names are prefixed with the site
+        name, controller config is put under the site name
+        :return:
+        """
+        namespaced_update = {
+            'devices': [],
+            'controller_config': {}
+        }
+        now = time.time()
+        for curr_dev in update_data['devices']:
+            curr_dev = copy.deepcopy(curr_dev)
+            curr_dev['name'] = namespaced_name(self.name, curr_dev['name'])
+            if 'stale_times' in curr_dev:
+                curr_dev['stale'] = {curr_param: now - curr_time
+                                     for curr_param, curr_time in curr_dev.pop('stale_times').items()}
+            curr_dev['site'] = self.name
+            namespaced_update['devices'].append(curr_dev)
+        if update_data.get('controller_config'):
+            namespaced_update['controller_config'][self.name] = copy.deepcopy(update_data['controller_config'])
+        return namespaced_update
+
+    def namespaced_state(self):
+        with self.state_lock:
+            return self.__namespaced_update({
+                'devices': list(self.devices.values()),
+                'controller_config': self.controller_config
+            })
+
+    def namespaced_descriptions(self):
+        """
+        :return: Site's peripheral devices descriptions with names prefixed with the site name. Empty list if they have
+        not been fetched yet
+        """
+        with self.state_lock:
+            descriptions = copy.deepcopy(self.descriptions or [])
+        for curr_dev_descr in descriptions:
+            # Localized names are only used for display
+            for curr_key in curr_dev_descr:
+                if curr_key.startswith('name_'):
+                    curr_dev_descr[curr_key] = '{}: {}'.format(self.name, curr_dev_descr[curr_key])
+            curr_dev_descr['name'] = namespaced_name(self.name, curr_dev_descr['name'])
+        return descriptions
+
+    def send_user_command(self, command_text):
+        status, data = self.pool.request('POST', '/command', command_text,
+                                         {'Content-Type': 'application/json; charset=utf-8'})
+        return status, str(data, self.gateway.encoding)
+
+
+class GatewayHTTPServer(CustomHTTPServer):
+    """
+    Aggregates several SmartDacha controllers (sites) into one. Serves the same API as CustomHTTPServer, so browsers
+    only need to hold connections to the gateway. Devices' names are namespaced with the site name
+    (e.g. 'plot_1/greenhouse'), controller configs are put under site names:
+    {
+        "time": 12345454.545323
+        "devices": [
+            {
+                "name": "plot_1/well_and_tank",
+                "site": "plot_1",
+                "parameters": {...},
+                "online": true
+            },
+            ...
+        ],
+        "controller_config": {
+            "plot_1": {
+                "pump_auto_control_turn_off_when_tank_full": true
+            },
+            ...
+        }
+    }
+    User commands are routed to the site the target device belongs to.
+    """
+
+    def __init__(self, server_address, sites_config, main_page_file_name_template, main_page_template_file_name,
+                 favicon_file_name, retry_connection_delay=10):
+        """
+        :param sites_config: List of sites. Sample format:
+        [
+            {"name": "plot_1", "host": "192.168.1.10", "port": 3228},
+            ...
+        ]
+        """
+        super(GatewayHTTPServer, self).__init__(server_address, main_page_file_name_template, favicon_file_name,
+                                                controller=None)
+        self.retry_connection_delay = retry_connection_delay
+        with open(main_page_template_file_name) as template_file:
+            self.main_page_template = Template(template_file.read())
+        self.main_page_render_lock = Lock()
+        self.sites = {}
+        for curr_site_config in sites_config:
+            self.sites[curr_site_config['name']] = UpstreamSite(curr_site_config['name'], curr_site_config['host'],
+                                                                curr_site_config['port'], self)
+        self.user_command_callback = self.route_user_command
+        # Main page is rendered again whenever a site's devices descriptions are fetched
+        self.render_main_pages()
+
+    def start_upstreams(self):
+        for curr_site in self.sites.values():
+            curr_site.start()
+
+    def get_full_state(self):
+        state_copy = {
+            'time': self.last_update_time,
+            'devices': [],
+            'controller_config': {}
+        }
+        for curr_site in self.sites.values():
+            curr_site_state = curr_site.namespaced_state()
+            state_copy['devices'] += curr_site_state['devices']
+            state_copy['controller_config'].update(curr_site_state['controller_config'])
+        return state_copy
+
+    def get_devices_descriptions(self):
+        descriptions = []
+        for curr_site in self.sites.values():
+            descriptions += curr_site.namespaced_descriptions()
+        return descriptions
+
+    def render_main_pages(self):
+        descriptions = self.get_devices_descriptions()
+        with self.main_page_render_lock:
+            for curr_locale in ('en', 'ru'):
+                page_file_name = '{}_{}.html'.format(self.main_page_file_name_template, curr_locale)
+                # The page may be being served at the same time. Replacing it at once so that a client never gets a
+                # partially written one
+                temp_file_name = page_file_name + '.tmp'
+                with open(temp_file_name, 'w') as page_file:
+                    page_file.write(self.main_page_template.render({'periph_devices_descriptions': descriptions,
+                                                                    'locale': curr_locale}))
+                os.replace(temp_file_name, page_file_name)
+
+    def route_user_command(self, command_text):
+        """
+        Forwards user commands to the sites the target devices belong to. Command format is the same as for
+        Controller.handle_user_command except the targets are namespaced names. Commands for the same site are
+        forwarded in one request. If any of the targets is invalid, none of the commands is forwarded, but a site may
+        still reject its commands while the other sites execute theirs
+        :param command_text: raw user-formed string
+        :return: (valid, errors) as for Controller.handle_user_command, except valid is also False if a site has
+        rejected its commands as invalid, while the other sites may have executed theirs
+        """
+        try:
+            commands = json.loads(command_text)
+        except json.JSONDecodeError:
+            logging.error('Gateway could not parse user command "%s"', command_text)
+            return False, ['Could not parse user command']
+        if not isinstance(commands, list):
+            commands = [commands]
+
+        # Grouping commands by site, keeping their order
+        sites_commands = {}
+        errors = []
+        for curr_command in commands:
+            try:
+                site_name, target = curr_command['target'].split(site_separator, 1)
+            except (KeyError, TypeError, AttributeError, ValueError):
+                errors.append('Invalid command format: {}'.format(curr_command))
+                continue
+            if site_name not in self.sites:
+                errors.append('No such site: {}'.format(site_name))
+                continue
+            sites_commands.setdefault(site_name, []).append(dict(curr_command, target=target))
+        if errors:
+            for curr_error in errors:
+                logging.error('Gateway: %s', curr_error)
+            return False, errors
+
+        valid = True
+        for curr_site_name, curr_commands in sites_commands.items():
+            try:
+                status, response_text = self.sites[curr_site_name].send_user_command(json.dumps(curr_commands))
+            except (OSError, HTTPException) as e:
+                logging.error('Gateway could not transfer commands to site %s: %s', curr_site_name, e)
+                errors.append('Could not transfer commands to site {}'.format(curr_site_name))
+                continue
+            if status != 200:
+                logging.error('Site %s responded %s to commands: "%s"', curr_site_name, status, response_text)
+                # Other statuses (e.g. 503 - some of the site's devices are offline) mean that the commands are valid
+                if status == 400:
+                    valid = False
+                try:
+                    site_errors = json.loads(response_text)['errors']
+                except (ValueError, KeyError, TypeError):
+                    site_errors = ['Site responded {}'.format(status)]
+                errors += ['{}: {}'.format(curr_site_name, curr_error) for curr_error in site_errors]
+        return valid, errors
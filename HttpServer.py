@@ -12,12 +12,16 @@ from collections import deque
 
 class CustomHTTPServer(ThreadingMixIn, HTTPServer):
     """
+    Connections are persistent (HTTP/1.1 keep-alive) and each of them is served by its own thread. Connection threads
+    are daemonic so that idle keep-alive connections do not prevent the server from being shut down.
 
     updates_buffer
         's purpose is to store the most recent updates for the case when the client has  missed some die to
         e.g. connection problems. If this happened, on the next update request all the missed updates will be packed
         into one packet and tranfsered to the client.
     """
+    daemon_threads = True
+
     def __init__(self, server_address, main_page_file_name_template, favicon_file_name, controller: Controller):
         super(CustomHTTPServer, self).__init__(server_address, CustomHTTPRequestHandler)
         with open(favicon_file_name, 'rb') as favicon_file:
@@ -40,17 +44,98 @@ class CustomHTTPServer(ThreadingMixIn, HTTPServer):
         self.device_parameter_updated_event.set()
         self.device_parameter_updated_event.clear()
 
+    def get_full_state(self):
+        """
+        Forms full state data structure (see '/initial_data' in CustomHTTPRequestHandler.do_GET)
+        :return: JSON-like Python data structure
+        """
+        state_copy = {
+            'time': self.last_update_time,
+            'devices': []
+        }
+        # Reading controller config
+        # Not forgetting to use locks
+        with self.controller.config_lock:
+            state_copy['controller_config'] = copy.deepcopy(self.controller.config)
+        # Reading devices' information
+        now = time.time()
+        for curr_dev_name, curr_dev in self.controller.periph_devices.items():
+            # Last known values of the parameters that have not been received from the device yet. Live values
+            # replace them
+            parameters = {}
+            stale = {}
+            for curr_param, (curr_value, curr_time) in curr_dev.stale_parameters.items():
+                parameters[curr_param] = curr_value
+                stale[curr_param] = now - curr_time
+            live_parameters = curr_dev.parameters
+            parameters.update(live_parameters)
+            # A parameter may have been received between the two reads
+            for curr_param in live_parameters:
+                stale.pop(curr_param, None)
+            state_copy['devices'].append({
+                'name': curr_dev_name,
+                'online': curr_dev.online.is_set(),
+                'parameters': parameters,
+                'stale': stale
+            })
+        return state_copy
+
+    def get_devices_descriptions(self):
+        return [curr_dev.description for curr_dev in self.controller.periph_devices.values()]
+
     def default_user_command_callback(self, command_text):
+        """
+        :return: (valid, errors) (see Controller.handle_user_command)
+        """
         logging.warning('Default user command callback handler called')
+        return True, []
 
 
 class CustomHTTPRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 connections are persistent by default, so the client may send all its update polls and commands over
+    # the same connection. Every response must have a Content-Length then (see self.send_data)
+    protocol_version = 'HTTP/1.1'
+    # Idle keep-alive connection timeout in seconds. The timeout is only applied to reading/writing the socket, so a
+    # long-poll that is waiting for an update is not affected by it
+    timeout = 60
+
     def __init__(self, request, client_address, server: CustomHTTPServer):
+        # Note that the request is handled right inside the base __init__
         super(CustomHTTPRequestHandler, self).__init__(request, client_address, server)
-        # As the client is subscribed to events for the whole session, the handler should never terminate it by itself
-        self.close_connection = False
         self.server = server
 
+    def send_data(self, data: bytes, content_type, code=200):
+        """
+        Sends a complete response with the correct framing headers for a persistent connection
+        :param data: Response body
+        :param content_type: Value of the Content-Type header
+        :param code: HTTP status code
+        :return:
+        """
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        # self.close_connection is set by the base class if the client asked to close the connection
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Connection', 'keep-alive')
+            self.send_header('Keep-Alive', 'timeout={}'.format(self.timeout))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        """
+        Reads the request body. It has to be read completely so that the next request on the same connection can be
+        parsed
+        :return: Body bytes or None if the request has no valid Content-Length
+        """
+        try:
+            content_length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            return None
+        return self.rfile.read(content_length)
+
     def do_GET(self):
 
         if self.path == '/initial_data':
@@ -79,7 +164,11 @@ class CustomHTTPRequestHandler(BaseHTTPRequestHandler):
                             'pump': 'off',
                             'tank': 'not_full'
                         }
-                        "online": false
+                        "online": false,
+                        "stale":
+                        {
+                            'temperature": 35.2
+                        }
                     },
                     ...
                 ],
@@ -87,37 +176,23 @@ class CustomHTTPRequestHandler(BaseHTTPRequestHandler):
                     "pump_auto_control_turn_off_when_tank_full": true
                 }
             }
+            "stale" lists the parameters which values are the last known ones (e.g. from before the restart), not yet
+            received from the device, with their age in seconds
             """
-            self.send_response(200)
-            self.end_headers()
-            # Forming full state data structure. It will be then stringified and sent to the client.
-            state_copy = {
-                'time': self.server.last_update_time,
-                'devices': []
-            }
-            # Reading controller config
-            # Not forgetting to use locks
-            with self.server.controller.config_lock:
-                state_copy['controller_config'] = copy.deepcopy(self.server.controller.config)
-            # Reading devices' information
-            for curr_dev_name, curr_dev in self.server.controller.periph_devices.items():
-                state_copy['devices'].append({
-                    'name': curr_dev_name,
-                    'online': curr_dev.online.is_set(),
-                    'parameters': copy.deepcopy(curr_dev.parameters)
-                })
             # Stingifying gathered data and sending it to the client
-            self.wfile.write(bytes(json.dumps(state_copy, indent='\t'), self.server.encoding))
+            self.send_data(bytes(json.dumps(self.server.get_full_state(), indent='\t'), self.server.encoding),
+                           'application/json; charset=' + self.server.encoding)
+        elif self.path == '/descriptions':
+            # Peripheral devices descriptions (see PeriphDevicesDescriptions.json). Used by the gateway (see Gateway.py)
+            # to build its own main page
+            self.send_data(bytes(json.dumps(self.server.get_devices_descriptions()), self.server.encoding),
+                           'application/json; charset=' + self.server.encoding)
         elif self.path == '/favicon.ico':
             # Favicon request
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(self.server.favicon_data)
+            self.send_data(self.server.favicon_data, 'image/x-icon')
         else:
             # Main page request.
             self.path = '/'
-            self.send_response(200)
-            self.end_headers()
             # Get requested locale or set to 'en' as default
             locale = self.headers.get('Accept-Language', 'en')[0:2]
             # Try opening the corresponding file
@@ -126,14 +201,18 @@ class CustomHTTPRequestHandler(BaseHTTPRequestHandler):
             except IOError:
                 # Could not open the localized page file. using default
                 main_page_data = open('{}_{}.html'.format(self.server.main_page_file_name_template, 'en')).read()
-            self.wfile.write(bytes(main_page_data, self.server.encoding))
+            self.send_data(bytes(main_page_data, self.server.encoding), 'text/html; charset=' + self.server.encoding)
 
     def do_POST(self):
         if self.path == '/updates':
             # Update long-poll request
             # Read last update time
+            body = self.read_body()
+            if body is None:
+                self.send_error(411)
+                return
             try:
-                client_last_update_time = float(self.rfile.read(int(self.headers['Content-Length'])))
+                client_last_update_time = float(body)
             except ValueError:
                 # Incorrect format
                 self.send_error(400)
@@ -142,8 +221,6 @@ class CustomHTTPRequestHandler(BaseHTTPRequestHandler):
             self.server.updates_buffer_lock.acquire()
             # noinspection PyUnboundLocalVariable
             if self.server.last_update_time > client_last_update_time:
-                self.send_response(200)
-                self.end_headers()
                 # Forming update data.
                 # Find the earliest unreceived update. Starting from the end. More likely to find it at the end
                 for curr_update in reversed(self.server.updates_buffer):
@@ -157,17 +234,28 @@ class CustomHTTPRequestHandler(BaseHTTPRequestHandler):
                 self.server.updates_buffer_lock.release()
                 self.server.device_parameter_updated_event.wait()
                 # A brand new update's at the end of update deque
-                self.send_response(200)
-                self.end_headers()
                 with self.server.updates_buffer_lock:
                     update_to_send = self.server.updates_buffer[-1]
-            self.wfile.write(bytes(json.dumps(update_to_send), self.server.encoding))
+            self.send_data(bytes(json.dumps(update_to_send), self.server.encoding),
+                           'application/json; charset=' + self.server.encoding)
         elif self.path == '/command':
-            self.server.user_command_callback(str(self.rfile.read(int(self.headers['Content-Length'])),
-                                                  self.server.encoding))
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(bytes('Command transferred', self.server.encoding))
+            body = self.read_body()
+            if body is None:
+                self.send_error(411)
+                return
+            # One command or an array of them (see Controller.handle_user_command). Response is the same for both:
+            # {"errors": [<error message>, ...]}. Status:
+            # 400 - a command is invalid, none of the commands has been executed
+            # 503 - the commands are valid, but some devices are offline. Only their commands have not been executed
+            valid, errors = self.server.user_command_callback(str(body, self.server.encoding))
+            if not valid:
+                code = 400
+            elif errors:
+                code = 503
+            else:
+                code = 200
+            self.send_data(bytes(json.dumps({'errors': errors}), self.server.encoding),
+                           'application/json; charset=' + self.server.encoding, code)
         else:
             self.send_error(400)
 
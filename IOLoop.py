@@ -0,0 +1,132 @@
+from collections import deque
+from threading import Lock, Thread
+import selectors
+import queue
+import logging
+import socket
+import heapq
+import time
+
+
+class IOLoop:
+    """
+    Single-threaded non-blocking I/O loop based on selectors. Used to serve all the stream (serial, TCP) peripheral
+    devices with one thread instead of a thread per device.
+    Callbacks (file object events, call_soon and call_later ones) are always called by the loop thread, so they must not
+    block. register, modify and unregister may only be called by the loop thread too (e.g. from a callback).
+    Work that may block (e.g. handling received data, which runs the automation logic and may write to a BLE device)
+    is handed over to the worker thread with run_in_worker. The worker calls the callbacks one by one in the order they
+    have been added.
+    call_soon, call_later and run_in_worker are safe for use by multiple threads.
+    """
+
+    def __init__(self):
+        self.__selector = selectors.DefaultSelector()
+        self.__callbacks_lock = Lock()
+        # (callback, args) to be called on the next loop iteration
+        self.__callbacks = deque()
+        # Heap of (time, sequence number, callback, args). Sequence number keeps callbacks with equal time in order
+        self.__timers = []
+        self.__timers_counter = 0
+        # Writing to this socket pair wakes the loop up when a callback is added by another thread
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+        self.__selector.register(self.__wakeup_reader, selectors.EVENT_READ, self.__handle_wakeup)
+        self.__thread = None
+        # (callback, args) to be called by the worker thread
+        self.__worker_queue = queue.Queue()
+        self.__worker_thread = None
+
+    def start(self):
+        """
+        Runs the loop in a new daemon thread
+        :return:
+        """
+        self.__thread = Thread(target=self.run_forever, name='IOLoop', daemon=True)
+        self.__thread.start()
+
+    def run_forever(self):
+        self.__worker_thread = Thread(target=self.__run_worker, name='IOLoop worker', daemon=True)
+        self.__worker_thread.start()
+        while True:
+            with self.__callbacks_lock:
+                if self.__callbacks:
+                    timeout = 0
+                elif self.__timers:
+                    timeout = max(self.__timers[0][0] - time.monotonic(), 0)
+                else:
+                    timeout = None
+            for key, mask in self.__selector.select(timeout):
+                self.__run_callback(key.data, key.fileobj, mask)
+            # Collecting due callbacks under the lock, calling them without it as they may add new ones
+            now = time.monotonic()
+            with self.__callbacks_lock:
+                while self.__timers and self.__timers[0][0] <= now:
+                    _, _, callback, args = heapq.heappop(self.__timers)
+                    self.__callbacks.append((callback, args))
+                callbacks = self.__callbacks
+                self.__callbacks = deque()
+            for callback, args in callbacks:
+                self.__run_callback(callback, *args)
+
+    def __run_worker(self):
+        while True:
+            callback, args = self.__worker_queue.get()
+            self.__run_callback(callback, *args)
+
+    @staticmethod
+    def __run_callback(callback, *args):
+        # One misbehaving device must not stop the others' I/O
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception('IOLoop: unhandled exception in callback %s', callback)
+
+    def __wakeup(self):
+        try:
+            self.__wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            # The buffer is full, which means that the loop is going to wake up anyway
+            pass
+
+    def __handle_wakeup(self, fileobj, mask):
+        try:
+            while self.__wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def call_soon(self, callback, *args):
+        with self.__callbacks_lock:
+            self.__callbacks.append((callback, args))
+        self.__wakeup()
+
+    def call_later(self, delay, callback, *args):
+        """
+        :param delay: In seconds
+        """
+        with self.__callbacks_lock:
+            self.__timers_counter += 1
+            heapq.heappush(self.__timers, (time.monotonic() + delay, self.__timers_counter, callback, args))
+        self.__wakeup()
+
+    def run_in_worker(self, callback, *args):
+        """
+        Schedules a callback that may block to be called by the worker thread
+        """
+        self.__worker_queue.put((callback, args))
+
+    def register(self, fileobj, events, callback):
+        """
+        :param fileobj: File object or file descriptor
+        :param events: selectors.EVENT_READ and/or selectors.EVENT_WRITE
+        :param callback: Called with (fileobj, mask) when fileobj is ready
+        """
+        self.__selector.register(fileobj, events, callback)
+
+    def modify(self, fileobj, events, callback):
+        self.__selector.modify(fileobj, events, callback)
+
+    def unregister(self, fileobj):
+        self.__selector.unregister(fileobj)
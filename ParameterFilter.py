@@ -0,0 +1,112 @@
+from collections import deque
+import time
+
+
+class ParameterFilter:
+    """
+    Decides which readings of a "float" parameter are worth publishing. Noisy sensors report values that differ by
+    a fraction of a degree all the time, and each published reading results in automation logic run and an update
+    sent to every client.
+    Filter description sample format (the "filter" attribute of a parameter in PeriphDevicesDescriptions.json). All the
+    attributes are optional:
+    {
+        "deadband": 0.3,
+        "relative_deadband": 0.01,
+        "min_interval": 10,
+        "averaging": 3
+    }
+    deadband - a reading is not published if it differs from the last published value by less than this
+    relative_deadband - same as deadband, but as a fraction of the last published value
+    min_interval - minimal time in seconds between two published readings
+    averaging - the published value is an average of this number of the latest readings. Requires min_interval, which
+    is the period the average is brought up to date with (see self.flush) when no more readings come
+    The first reading is always published. A change suppressed by min_interval is not lost: once the interval expires
+    it is published by self.flush, which is to be called then (see self.pending, self.next_publish_time).
+    Raises ValueError if the description is invalid
+    """
+
+    def __init__(self, filter_description):
+        if not isinstance(filter_description, dict):
+            raise ValueError('Filter description must be an object, got {}'.format(filter_description))
+        for curr_key, curr_value in filter_description.items():
+            if curr_key == 'averaging':
+                if isinstance(curr_value, bool) or not isinstance(curr_value, int) or curr_value < 1:
+                    raise ValueError('"averaging" must be a positive integer, got {}'.format(curr_value))
+            elif curr_key in ('deadband', 'relative_deadband', 'min_interval'):
+                if isinstance(curr_value, bool) or not isinstance(curr_value, (int, float)) or curr_value < 0:
+                    raise ValueError('"{}" must be a non-negative number, got {}'.format(curr_key, curr_value))
+            else:
+                raise ValueError('Unknown filter attribute "{}"'.format(curr_key))
+        if filter_description.get('averaging', 1) > 1 and not filter_description.get('min_interval', 0):
+            # Otherwise an average of the readings before and after a change would be stuck until the next reading
+            raise ValueError('"averaging" requires "min_interval"')
+        self.deadband = filter_description.get('deadband', 0.0)
+        self.relative_deadband = filter_description.get('relative_deadband', 0.0)
+        self.min_interval = filter_description.get('min_interval', 0.0)
+        self.__readings = deque(maxlen=filter_description.get('averaging', 1))
+        self.__last_reading = None
+        self.__published_value = None
+        self.__published_time = None
+
+    def filter(self, value: float, timestamp=None):
+        """
+        Takes a new reading
+        :param value: Raw parameter value
+        :param timestamp: Time of the reading in seconds. time.monotonic() is used if not specified
+        :return: Value to be published or None if the reading is to be suppressed
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.__last_reading = value
+        self.__readings.append(value)
+        value = self.__average()
+        if self.__published_value is not None:
+            if timestamp - self.__published_time < self.min_interval:
+                return None
+            if not self.__is_significant(value):
+                return None
+        self.__published_value = value
+        self.__published_time = timestamp
+        return value
+
+    def __average(self):
+        return sum(self.__readings) / len(self.__readings)
+
+    def __is_significant(self, value):
+        change = abs(value - self.__published_value)
+        return change >= self.deadband and change >= self.relative_deadband * abs(self.__published_value)
+
+    @property
+    def pending(self):
+        """
+        True if the latest reading has not been published (suppressed by min_interval or not yet reflected by the
+        average) and differs from the published value significantly, so self.flush has to be called
+        """
+        if self.min_interval <= 0 or self.__published_value is None:
+            return False
+        # Flushing will not change anything once all the readings averaged are the latest one and their average has
+        # been published
+        settled = all(curr_reading == self.__last_reading for curr_reading in self.__readings) and \
+            self.__published_value == self.__average()
+        return not settled and self.__is_significant(self.__last_reading)
+
+    @property
+    def next_publish_time(self):
+        """
+        :return: The earliest time (same clock as the timestamps) a value can be published at
+        """
+        if self.__published_time is None:
+            return 0.0
+        return self.__published_time + self.min_interval
+
+    def flush(self, timestamp=None):
+        """
+        To be called at self.next_publish_time while self.pending is True. The sensor is considered to keep its latest
+        reported value (sensors often only report changes), so it is taken as a new reading. This way the published
+        value reaches the latest reading in at most "averaging" intervals even if no more readings come
+        :param timestamp: Same as for self.filter
+        :return: Same as self.filter
+        """
+        if not self.pending:
+            return None
+        return self.filter(self.__last_reading, timestamp)
@@ -1,8 +1,17 @@
 import pygatt
 import logging
 import threading
+import selectors
+import socket
+import termios
+import errno
+import tty
+import os
 from enum import Enum
+from collections import namedtuple
 import copy
+import time
+from ParameterFilter import ParameterFilter
 
 
 class RaisedErrors(Enum):
@@ -16,6 +25,9 @@ class InternalErrors(Enum):
 
 
 class SimplePeriphDev:
+    class Exceptions:
+        class NotConnectedError(Exception):
+            pass
 
     def __init__(self, description):
         """
@@ -32,162 +44,213 @@ class SimplePeriphDev:
         self._lock = threading.Lock()
         # Function. Called when device's characteristics update
         self.parameter_updated_callback = self.default_parameter_updated_callback
+        # Function. Called for every reading received from the device, including the ones suppressed by parameter
+        # filters (e.g. for history recording)
+        self.raw_parameter_updated_callback = self.default_raw_parameter_updated_callback
         # Function. Called when the device encounters an error during its usage
         # (e.g. could not recognize command)
         self.error_callback = self.default_error_callback
         # Function. Called when the device goes offline
         self.gone_offline_callback = self.default_gone_offline_callback
+        self.online = threading.Event()
+        # An event which is set to one when device's parameters have been initialized
+        self.parameters_initialized = threading.Event()
+        # A buffer to write messages from device to
+        self._message_buffer = ''
+        # TrafficTrace.TrafficRecorder. If not None, all the device's traffic is recorded
+        self.traffic_recorder = None
         # self.parameters is not meant to be changed directly. Use self. send_command
         self._parameters = {}
+        # Time (time.time()) each parameter has last been reported by the device at, including the readings suppressed by
+        # its filter
+        self._parameters_times = {}
+        # Last known parameter values that have not been received from the device since the controller started (e.g.
+        # restored from a snapshot, see StateSnapshot.py). Format: {<parameter>: (<value>, <time>)}
+        self._stale_parameters = {}
+        # Filters for the parameters that have a "filter" attribute in their description (see ParameterFilter)
+        self._parameter_filters = {}
+        # Guards the filters, which are used both on receiving the data and on flushing (see
+        # self.__schedule_filter_flush)
+        self.__filters_lock = threading.Lock()
+        # Names of the parameters which filters are scheduled to be flushed
+        self.__filter_flushes_scheduled = set()
+        for curr_param in self.description['parameters']:
+            if 'filter' in curr_param:
+                if curr_param['type'] == 'float':
+                    try:
+                        self._parameter_filters[curr_param['name']] = ParameterFilter(curr_param['filter'])
+                    except ValueError as e:
+                        logging.error('Device "%s": invalid filter of "%s" (%s). The parameter is not filtered', self,
+                                      curr_param['name'], e)
+                else:
+                    logging.warning('Device "%s": filter is only supported for "float" parameters, "%s" is "%s"',
+                                    self, curr_param['name'], curr_param['type'])
 
         #for curr_param in self.description['parameters']:
         #    self.parameters[curr_param['name']] = None
 
     @property
     def parameters(self):
-        raise NotImplementedError
+        """
+        Returns a copy of self.__parameters
+        Not all parameters may be initialized
+        :return:
+        """
+        with self._lock:
+            return copy.deepcopy(self._parameters)
 
-    # Sends ASCII text to the device.
-    def __send_text(self, text: str):
+    @property
+    def stale_parameters(self):
+        """
+        Returns a copy of self._stale_parameters. A parameter is removed from there as soon as it is received from the
+        device
+        :return:
+        """
+        with self._lock:
+            return copy.deepcopy(self._stale_parameters)
+
+    def restore_parameters(self, parameters_snapshot):
+        """
+        Sets last known parameter values as stale ones. Parameters that have already been received from the device and
+        the ones not in the device description are ignored. So are invalid entries (e.g. a "bool" parameter's value
+        that is not one of its states), with an error logged
+        :param parameters_snapshot: Format is the same as returned by self.get_parameters_snapshot
+        :return:
+        """
+        described_parameters = {curr_param['name']: curr_param for curr_param in self.description['parameters']}
+        with self._lock:
+            for curr_param, curr_entry in parameters_snapshot.items():
+                curr_param_description = described_parameters.get(curr_param, None)
+                if curr_param_description is None or curr_param in self._parameters:
+                    continue
+                if not self.__is_valid_snapshot_entry(curr_param_description, curr_entry):
+                    logging.error('Device "%s": invalid snapshot entry of "%s": %s. Skipping it', self, curr_param,
+                                  curr_entry)
+                    continue
+                self._stale_parameters[curr_param] = tuple(curr_entry)
+
+    @staticmethod
+    def __is_valid_snapshot_entry(parameter_description, entry):
+        """
+        :param entry: [<value>, <time>]
+        """
+        if not isinstance(entry, (list, tuple)) or len(entry) != 2:
+            return False
+        value, entry_time = entry
+        if isinstance(entry_time, bool) or not isinstance(entry_time, (int, float)):
+            return False
+        if parameter_description['type'] == 'bool':
+            return value in parameter_description['states']
+        if parameter_description['type'] == 'float':
+            return not isinstance(value, bool) and isinstance(value, (int, float))
+        return False
+
+    def get_parameters_snapshot(self):
+        """
+        :return: Last known value of each parameter and the time it has been received at, including stale ones:
+        {<parameter>: [<value>, <time>]}
+        """
+        with self._lock:
+            parameters_snapshot = {curr_param: [curr_value, curr_time]
+                                   for curr_param, (curr_value, curr_time) in self._stale_parameters.items()}
+            for curr_param, curr_value in self._parameters.items():
+                parameters_snapshot[curr_param] = [curr_value, self._parameters_times[curr_param]]
+        return parameters_snapshot
+
+    # Sends ASCII text to the device. Raises self.Exceptions.NotConnectedError if the device is offline
+    def _send_text(self, text: str):
         raise NotImplementedError
 
+    def _call_later(self, delay, callback, *args):
+        """
+        Calls callback after delay (in seconds) in the same context received data is handled in (see
+        _handle_received_data), so that the parameter updates reach the callbacks the same way whatever has produced
+        them. Transports which handle received data in a particular thread override this. By default a new daemon
+        thread is used
+        :return:
+        """
+        timer = threading.Timer(delay, callback, args=args)
+        timer.daemon = True
+        timer.start()
+
     def default_parameter_updated_callback(self, device, parameter, value):
         logging.info('Default update callback has been called for "%s" device. %s:%s', device, parameter, value)
 
+    def default_raw_parameter_updated_callback(self, device, parameter, value):
+        pass
+
     def default_error_callback(self, device, code, message):
         logging.warning('Default error callback has been called for "%s" device. Message: "%s"', device, message)
 
     def default_gone_offline_callback(self, device):
         logging.warning('Default gone ofline callback has been called for "%s" device.', device)
 
-    def send_command(self, parameter, value):
+    def send_command(self, parameter, command):
         """
-        Tries to change a controllable parameter "parameter" to "value".
+        Tries to change a controllable parameter "parameter" with "command".
         :param parameter: Parameter to be changed
-        :param value: Value to be assigned to the specified parameter
+        :param command: Command to be sent for the specified parameter
         :return:
         """
-        raise NotImplementedError
-
-    def __init_parameters(self):
-        raise NotImplementedError
-
-    def __str__(self):
-        return self.description['name']
-
-
-# BLE peripheral device with simple real/integer/boolean parameters and controls
-# E.g. this class can be used for accessing well controller peripheral, but it is not designed for, say, video-camera
-# modules peripherals
-class SimpleBlePeriphDev(SimplePeriphDev):
-    class Exceptions:
-        class NotConnectedError(Exception):
-            pass
-
-    # BLE module serial characteristic handle is 0x025
-    bleModuleSerialCharHandle = 0x025
-    bleModuleSerialCharUUID = '0000ffe1-0000-1000-8000-00805f9b34fb'
-
-    # update_handler is a function that is going to be called if the device sends a notification
-    def __init__(self, description, ble_adapter, blocking_connect=False, blocking_param_init=False):
-        """
-        Safe for use by multiple threads, has embedded lock
-        :param description:
-        :param ble_adapter: pygatt Backend
-        :param blocking: If True, blocks until the device's parameters are initialized.
-        """
-        super(SimpleBlePeriphDev, self).__init__(description)
-        self.__ble_adapter = ble_adapter
-        self.__conn = None
-        self.online = threading.Event()
-        self.__connect(blocking=blocking_connect)
-        # A buffer to write messages from device to
-        self.__message_buffer = ''
-        # An event which is set to one when device's parameters have been initialized
-        self.parameters_initialized = threading.Event()
-        self.__init_parameters(blocking=blocking_param_init)
+        self.send_commands([(parameter, command)])
 
-    @property
-    def parameters(self):
+    def send_commands(self, commands):
         """
-        Returns a copy of self.__parameters
-        Not all parameters may be initialized
-        :return:
+        Sends several commands to the device in one write:
+        PRM:<param_1>:<command_1>;PRM:<param_2>:<command_2>;...
+        :param commands: List of (parameter, command) tuples
+        :return: False if the device is offline and the commands have not been sent, True otherwise
         """
+        logging.info("To %s commands %s", self, commands)
+        # Let's check if we need to transfer any text or the parameters are already in the requested states
         with self._lock:
-            return copy.deepcopy(self._parameters)
-
-    def send_command(self, parameter, command):
-        # Let's check if we need to transfer any text or the parameter is already in the requested parameters
-        logging.info("To %s command %s:%s", self, parameter, command)
-        with self._lock:
-            skip = self._parameters.get(parameter, None) == command
-        if skip:
-            pass
-        else:
+            commands = [(curr_parameter, curr_command) for curr_parameter, curr_command in commands
+                        if self._parameters.get(curr_parameter, None) != curr_command]
+        if commands:
             try:
-                self.__send_text('PRM:{}:{}'.format(parameter, command))
-            except self.exceptions.NotConnectedError:
+                self._send_text(';'.join('PRM:{}:{}'.format(curr_parameter, curr_command)
+                                         for curr_parameter, curr_command in commands))
+            except self.Exceptions.NotConnectedError:
                 logging.error('Attempted to send a command to the disonnected device %s', self)
+                return False
+        return True
 
-    # Sends ASCII text to the device. text cannot be an empty string
-    def __send_text(self, text: str):
-        """
-        Sends ASCII text to the BLE device. Protocol:
-        :param text:
-        :return:
+    def _handle_received_data(self, raw_data: bytes):
         """
-        # ';' is a termination symbol
-        if self.online.is_set():
-            try:
-                self.__conn.char_write(uuid=self.bleModuleSerialCharUUID,
-                                       value=str.encode(text + ';', encoding='ASCII'),
-                                       wait_for_response=True)
-                logging.debug('To dev {} sent "{}"'.format(self, text))
-            except pygatt.exceptions.NotConnectedError:
-                self.__handle_not_connected()
-        else:
-            # Raise or handle?
-            raise self.Exceptions.NotConnectedError
-
-    def __handle_notification(self, handle, raw_data):
-        """
-        Called by pygatt when a BLE device sends a notification. Therefore it is not possible that this method is called
-        by multiple threads (if it is used right). If the device sends a long message, this method will be called
-        multiple times consequently and the message is going to be transmitted by parts.
-        Threrefore we're using end of transmission symbol - ';'. Also we're using self.__notification_buffer
-
-        :param handle:
+        Called by transport implementations when a part of the device's output is received. It is not possible that this
+        method is called by multiple threads (if it is used right). A long message may be transmitted by parts, so
+        this method may be called multiple times before the message is complete.
+        Threrefore we're using end of transmission symbol - ';'. Also we're using self._message_buffer
         :param raw_data:
         :return:
         """
         max_buffer_length = 256
         # Consider locking less code <efficiency>
         raw_string = raw_data.decode('ASCII')
-        logging.info('PeriphDev %s notif raw: "%s"', self, raw_string)
+        logging.info('PeriphDev %s received raw: "%s"', self, raw_string)
         curr_message_start = 0
         while curr_message_start < len(raw_string):
             terminal_pos = raw_string.find(';', curr_message_start)
             if terminal_pos == -1:
                 # No message end found. Buffering
                 # Check whether max buffer length is exceeded
-                if len(self.__message_buffer) + len(raw_string) > max_buffer_length:
+                if len(self._message_buffer) + len(raw_string) > max_buffer_length:
                     self.internal_error_handler(InternalErrors.MaxBufferLengthExceeded,
                                                 'Maximum buffer length exceeded')
                     return
-                self.__message_buffer += raw_string[curr_message_start:]
+                self._message_buffer += raw_string[curr_message_start:]
                 # Stop processing this string
                 break
             else:
                 # Found a message termianal symbol
-                self.__handle_message(self.__message_buffer + raw_string[curr_message_start:terminal_pos])
+                self.__handle_message(self._message_buffer + raw_string[curr_message_start:terminal_pos])
                 # Omitting terminal symbol
                 curr_message_start = terminal_pos + 1
-                self.__message_buffer = ''
+                self._message_buffer = ''
 
     def __handle_message(self, message: str):
         """
-        Called by __handle_notification (it cannot happen that this method is used by multiple threads (if it is used
+        Called by _handle_received_data (it cannot happen that this method is used by multiple threads (if it is used
         right).
         Parses the received message and performs corresponding actions.
         This method can only be called by one thread
@@ -244,22 +307,23 @@ class SimpleBlePeriphDev(SimplePeriphDev):
                             else:
                                 raise NotImplementedError('Parameter format "{}" is not supported'.
                                                           format(curr_param_description['type']))
-                            # Everything's alright, changing self.parameters, calling parameter_updated_callback
-                            with self._lock:
-                                self._parameters[parameter_name] = parameter_value
-                            # If the device is not initialized yet, check if all parameters are added, set the device to
-                            # initialized, if true. Branch predictor should help CPU omit this when it is initialized
-                            if not self.parameters_initialized.is_set():
-                                for curr_param in self.description['parameters']:
-                                    if curr_param['name'] not in self._parameters:
-                                        # Found a parameter that is still not initialized
-                                        break
-                                else:
-                                    # No uninitialized parameters found
-                                    self.parameters_initialized.set()
-                                    logging.info("Device {} 's parameters have been initialized".format(self))
-                            self.parameter_updated_callback(device=self, parameter=parameter_name,
-                                                            value=parameter_value)
+                            self.raw_parameter_updated_callback(device=self, parameter=parameter_name,
+                                                                value=parameter_value)
+                            # Only filtered parameters are in self._parameter_filters
+                            parameter_filter = self._parameter_filters.get(parameter_name, None)
+                            if parameter_filter is not None:
+                                with self.__filters_lock:
+                                    parameter_value = parameter_filter.filter(parameter_value)
+                                    self.__schedule_filter_flush(parameter_name, parameter_filter)
+                                if parameter_value is None:
+                                    # The reading is not worth publishing (e.g. it is within deadband). Still, it
+                                    # confirms that the published value is up to date (see get_parameters_snapshot)
+                                    with self._lock:
+                                        if parameter_name in self._parameters:
+                                            self._parameters_times[parameter_name] = time.time()
+                                    break
+                            # Everything's alright
+                            self.__publish_parameter(parameter_name, parameter_value)
                             # Stop searching for parameter, it's found already
                             break
                     else:
@@ -271,18 +335,148 @@ class SimpleBlePeriphDev(SimplePeriphDev):
             else:
                 self.internal_error_handler(InternalErrors.InvalidFormat, 'Invalid message type: "' + message + '"')
 
+    def __publish_parameter(self, parameter_name, parameter_value):
+        """
+        Changes self.parameters, calls parameter_updated_callback
+        :return:
+        """
+        with self._lock:
+            self._parameters[parameter_name] = parameter_value
+            self._parameters_times[parameter_name] = time.time()
+            self._stale_parameters.pop(parameter_name, None)
+        # If the device is not initialized yet, check if all parameters are added, set the device to
+        # initialized, if true. Branch predictor should help CPU omit this when it is initialized
+        if not self.parameters_initialized.is_set():
+            for curr_param in self.description['parameters']:
+                if curr_param['name'] not in self._parameters:
+                    # Found a parameter that is still not initialized
+                    break
+            else:
+                # No uninitialized parameters found
+                self.parameters_initialized.set()
+                logging.info("Device {} 's parameters have been initialized".format(self))
+        self.parameter_updated_callback(device=self, parameter=parameter_name, value=parameter_value)
+
+    def __schedule_filter_flush(self, parameter_name, parameter_filter):
+        """
+        If the parameter's filter has suppressed a reading that is still to be published, makes sure that
+        ParameterFilter.flush is called when it is time to publish it. self.__filters_lock must be acquired
+        :return:
+        """
+        if not parameter_filter.pending or parameter_name in self.__filter_flushes_scheduled:
+            return
+        self.__filter_flushes_scheduled.add(parameter_name)
+        self._call_later(max(parameter_filter.next_publish_time - time.monotonic(), 0), self.__flush_filter,
+                         parameter_name)
+
+    def __flush_filter(self, parameter_name):
+        """
+        Scheduled by self.__schedule_filter_flush
+        :return:
+        """
+        parameter_filter = self._parameter_filters[parameter_name]
+        with self.__filters_lock:
+            self.__filter_flushes_scheduled.remove(parameter_name)
+            parameter_value = parameter_filter.flush()
+            # More readings may be needed for the average to reach the latest one
+            self.__schedule_filter_flush(parameter_name, parameter_filter)
+        if parameter_value is not None:
+            self.__publish_parameter(parameter_name, parameter_value)
+
+    def internal_error_handler(self, code, message):
+        logging.error('Device "{}": an internal error has occurred: {}'.format(self, message))
+
+    def __init_parameters(self):
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.description['name']
+
+
+# BLE peripheral device with simple real/integer/boolean parameters and controls
+# E.g. this class can be used for accessing well controller peripheral, but it is not designed for, say, video-camera
+# modules peripherals
+class SimpleBlePeriphDev(SimplePeriphDev):
+    # BLE module serial characteristic handle is 0x025
+    bleModuleSerialCharHandle = 0x025
+    bleModuleSerialCharUUID = '0000ffe1-0000-1000-8000-00805f9b34fb'
+    # ATT payload size at the default MTU. Longer writes would have to be ATT long writes, which the module does not
+    # support
+    bleModuleMaxWriteLength = 20
+
+    # update_handler is a function that is going to be called if the device sends a notification
+    def __init__(self, description, ble_adapter, blocking_connect=False, blocking_param_init=False,
+                 traffic_recorder=None):
+        """
+        Safe for use by multiple threads, has embedded lock
+        :param description:
+        :param ble_adapter: pygatt Backend
+        :param blocking: If True, blocks until the device's parameters are initialized.
+        :param traffic_recorder: TrafficTrace.TrafficRecorder. If specified, all the device's traffic is recorded
+        """
+        super(SimpleBlePeriphDev, self).__init__(description)
+        self.__ble_adapter = ble_adapter
+        self.traffic_recorder = traffic_recorder
+        self.__conn = None
+        # Keeps the parts of a text from being mixed up with another text's ones
+        self.__write_lock = threading.Lock()
+        self.__connect(blocking=blocking_connect)
+        self.__init_parameters(blocking=blocking_param_init)
+
+    # Sends ASCII text to the device. text cannot be an empty string
+    def _send_text(self, text: str):
+        """
+        Sends ASCII text to the BLE device. A long text (e.g. several commands) is written by parts of at most
+        self.bleModuleMaxWriteLength bytes, in order. The device puts them together the same way
+        _handle_received_data does. Protocol:
+        :param text:
+        :return:
+        """
+        # ';' is a termination symbol
+        if self.online.is_set():
+            data = str.encode(text + ';', encoding='ASCII')
+            try:
+                with self.__write_lock:
+                    for curr_part_start in range(0, len(data), self.bleModuleMaxWriteLength):
+                        curr_part = data[curr_part_start:curr_part_start + self.bleModuleMaxWriteLength]
+                        self.__conn.char_write(uuid=self.bleModuleSerialCharUUID, value=curr_part,
+                                               wait_for_response=True)
+                        if self.traffic_recorder is not None:
+                            self.traffic_recorder.record_write(self, curr_part)
+                logging.debug('To dev {} sent "{}"'.format(self, text))
+            except pygatt.exceptions.NotConnectedError:
+                self.__handle_not_connected()
+                raise self.Exceptions.NotConnectedError
+        else:
+            # Raise or handle?
+            raise self.Exceptions.NotConnectedError
+
+    def __handle_notification(self, handle, raw_data):
+        """
+        Called by pygatt when a BLE device sends a notification. Therefore it is not possible that this method is called
+        by multiple threads (if it is used right). If the device sends a long message, this method will be called
+        multiple times consequently and the message is going to be transmitted by parts.
+        The parts are put together by self._handle_received_data
+
+        :param handle:
+        :param raw_data:
+        :return:
+        """
+        if self.traffic_recorder is not None:
+            self.traffic_recorder.record_notification(self, raw_data)
+        self._handle_received_data(raw_data)
+
     def __handle_not_connected(self):
         # If online has already been set to False, that means that we're already trying to reconnect
         if self.online.is_set():
             logging.warning('Device {} has gone offline. Trying to reconnect'.format(self))
+            if self.traffic_recorder is not None:
+                self.traffic_recorder.record_disconnect(self)
             with self._lock:
                 self.online.clear()
                 self.__connect(blocking=False)
             self.gone_offline_callback(self)
 
-    def internal_error_handler(self, code, message):
-        logging.error('Device "{}": an internal error has occurred: {}'.format(self, message))
-
     def __request_state_when_comes_online(self):
         """
         Designed to be called by __init_parameters. Blocks until 'STATE' message is sent to the device
@@ -292,7 +486,7 @@ class SimpleBlePeriphDev(SimplePeriphDev):
         while not success:
             self.online.wait()
             try:
-                self.__send_text('STATE')
+                self._send_text('STATE')
                 success = True
             except self.Exceptions.NotConnectedError:
                 self.__handle_not_connected()
@@ -329,6 +523,8 @@ class SimpleBlePeriphDev(SimplePeriphDev):
                 pass
 
         logging.info('%s connected', self)
+        if self.traffic_recorder is not None:
+            self.traffic_recorder.record_connect(self)
         with self._lock:
             self.online.set()
             self.__conn = new_connection
@@ -355,3 +551,300 @@ class SimpleBlePeriphDev(SimplePeriphDev):
             return '{} MAC: {}\tonline'.format(self.description['name'], self.description['MAC'])
         else:
             return '{} MAC: {}\toffline'.format(self.description['name'], self.description['MAC'])
+
+
+class SimpleStreamPeriphDev(SimplePeriphDev):
+    """
+    Peripheral device that speaks the same text protocol as SimpleBlePeriphDev over a byte stream (e.g. serial port or
+    TCP connection). All the I/O is performed by an IOLoop, which can serve many devices with one thread.
+    Subclasses implement opening, reading, writing and closing the stream. These methods are called by the loop thread
+    and must not block. Received data is handled (and the callbacks are called) by the loop's worker thread, so a slow
+    callback does not hold up the other devices' I/O.
+    Safe for use by multiple threads, has embedded lock
+    """
+    max_read_size = 4096
+
+    def __init__(self, description, io_loop, traffic_recorder=None, retry_connection_delay=10):
+        """
+        :param description:
+        :param io_loop: IOLoop.IOLoop
+        :param traffic_recorder: TrafficTrace.TrafficRecorder. If specified, all the device's traffic is recorded
+        :param retry_connection_delay: In seconds
+        """
+        super(SimpleStreamPeriphDev, self).__init__(description)
+        self.io_loop = io_loop
+        self.traffic_recorder = traffic_recorder
+        self.retry_connection_delay = retry_connection_delay
+        # The fields below are only accessed by the loop thread
+        # Stream file object as returned by self._open_stream. None when not connected
+        self.__stream = None
+        self.__write_buffer = bytearray()
+        self.__start_connecting()
+
+    def _resolve_address(self):
+        """
+        Called by the loop's worker thread before each connection attempt, so it may block (e.g. to resolve a host
+        name). Raises OSError on failure
+        :return:
+        """
+        pass
+
+    def _open_stream(self):
+        """
+        Starts opening the stream. Raises OSError on failure
+        :return: Non-blocking file object or file descriptor to be used with selectors
+        """
+        raise NotImplementedError
+
+    def _check_stream_opened(self, stream):
+        """
+        Called when the stream being opened becomes writable for the first time. Raises OSError if opening has failed
+        (e.g. TCP connection refused)
+        """
+        pass
+
+    def _read(self, stream):
+        """
+        :return: Received bytes, b'' if the stream has been closed by the other side or None if there is nothing to
+        read yet. Raises OSError on failure
+        """
+        raise NotImplementedError
+
+    def _write(self, stream, data):
+        """
+        :return: Number of bytes written. Raises OSError on failure
+        """
+        raise NotImplementedError
+
+    def _close_stream(self, stream):
+        raise NotImplementedError
+
+    # Sends ASCII text to the device. text cannot be an empty string
+    def _send_text(self, text: str):
+        # ';' is a termination symbol
+        if not self.online.is_set():
+            raise self.Exceptions.NotConnectedError
+        data = str.encode(text + ';', encoding='ASCII')
+        self.io_loop.call_soon(self.__queue_write, data)
+
+    def __queue_write(self, data):
+        if self.__stream is None:
+            logging.error('Device %s went offline before "%s" was sent', self, data)
+            return
+        logging.debug('To dev {} sent "{}"'.format(self, data))
+        if self.traffic_recorder is not None:
+            self.traffic_recorder.record_write(self, data)
+        self.__write_buffer += data
+        self.io_loop.modify(self.__stream, selectors.EVENT_READ | selectors.EVENT_WRITE, self.__handle_stream_events)
+
+    def __start_connecting(self):
+        self.io_loop.run_in_worker(self.__prepare_connection)
+
+    def __prepare_connection(self):
+        try:
+            self._resolve_address()
+        except OSError as e:
+            logging.debug('Could not connect to %s: %s', self, e)
+            self.io_loop.call_later(self.retry_connection_delay, self.__start_connecting)
+            return
+        self.io_loop.call_soon(self.__connect)
+
+    def __connect(self):
+        try:
+            self.__stream = self._open_stream()
+        except OSError as e:
+            logging.debug('Could not connect to %s: %s', self, e)
+            self.io_loop.call_later(self.retry_connection_delay, self.__start_connecting)
+            return
+        # The stream becomes writable when it is opened
+        self.io_loop.register(self.__stream, selectors.EVENT_WRITE, self.__handle_stream_opening)
+
+    def __handle_stream_opening(self, stream, mask):
+        try:
+            self._check_stream_opened(stream)
+        except OSError as e:
+            logging.debug('Could not connect to %s: %s', self, e)
+            self.io_loop.unregister(stream)
+            self.__close()
+            self.io_loop.call_later(self.retry_connection_delay, self.__start_connecting)
+            return
+        logging.info('%s connected', self)
+        if self.traffic_recorder is not None:
+            self.traffic_recorder.record_connect(self)
+        # The message buffer belongs to the worker thread. Whatever is left there is from the previous connection
+        self.io_loop.run_in_worker(self.__clear_message_buffer)
+        self.io_loop.modify(stream, selectors.EVENT_READ, self.__handle_stream_events)
+        self.online.set()
+        # Requesting all the parameters each time the device connects. They may have changed while it was offline
+        self.__queue_write(str.encode('STATE;', encoding='ASCII'))
+
+    def __handle_stream_events(self, stream, mask):
+        try:
+            if mask & selectors.EVENT_READ:
+                raw_data = self._read(stream)
+                if raw_data == b'':
+                    raise ConnectionResetError('Stream closed by the device')
+                if raw_data is not None:
+                    if self.traffic_recorder is not None:
+                        self.traffic_recorder.record_notification(self, raw_data)
+                    # Handling the data runs the callbacks, which may block
+                    self.io_loop.run_in_worker(self._handle_received_data, raw_data)
+            # Checking self.__stream as the data handler may have closed it
+            if mask & selectors.EVENT_WRITE and self.__stream is not None:
+                written = self._write(stream, self.__write_buffer)
+                del self.__write_buffer[:written]
+                if not self.__write_buffer:
+                    self.io_loop.modify(stream, selectors.EVENT_READ, self.__handle_stream_events)
+        except OSError as e:
+            self.__handle_not_connected(e)
+
+    def __handle_not_connected(self, reason):
+        logging.warning('Device {} has gone offline ({}). Trying to reconnect'.format(self, reason))
+        if self.traffic_recorder is not None:
+            self.traffic_recorder.record_disconnect(self)
+        self.io_loop.unregister(self.__stream)
+        self.__close()
+        self.online.clear()
+        self.io_loop.run_in_worker(self.gone_offline_callback, self)
+        self.io_loop.call_later(self.retry_connection_delay, self.__start_connecting)
+
+    def _call_later(self, delay, callback, *args):
+        # Received data is handled by the loop's worker thread
+        self.io_loop.call_later(delay, self.io_loop.run_in_worker, callback, *args)
+
+    def __clear_message_buffer(self):
+        self._message_buffer = ''
+
+    def __close(self):
+        try:
+            self._close_stream(self.__stream)
+        except OSError:
+            pass
+        self.__stream = None
+        self.__write_buffer.clear()
+
+    def __repr__(self):
+        return '{} {}\t{}'.format(self.description['name'], self.description['type'],
+                                  'online' if self.online.is_set() else 'offline')
+
+
+class SimpleSerialPeriphDev(SimpleStreamPeriphDev):
+    """
+    Device connected to a serial port (e.g. USB serial adapter).
+    Description attributes: "port" - e.g. "/dev/ttyUSB0", "baud_rate" - optional, 9600 by default
+    """
+
+    def _open_stream(self):
+        fd = os.open(self.description['port'], os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(fd)
+            attributes = termios.tcgetattr(fd)
+            baud_rate = getattr(termios, 'B{}'.format(self.description.get('baud_rate', 9600)))
+            # Input and output speeds
+            attributes[4] = attributes[5] = baud_rate
+            termios.tcsetattr(fd, termios.TCSANOW, attributes)
+        except (termios.error, AttributeError) as e:
+            os.close(fd)
+            raise OSError('Could not configure serial port: {}'.format(e))
+        return fd
+
+    def _read(self, stream):
+        try:
+            return os.read(stream, self.max_read_size)
+        except BlockingIOError:
+            return None
+
+    def _write(self, stream, data):
+        try:
+            return os.write(stream, data)
+        except BlockingIOError:
+            return 0
+
+    def _close_stream(self, stream):
+        os.close(stream)
+
+
+class SimpleTcpPeriphDev(SimpleStreamPeriphDev):
+    """
+    Device connected over TCP (e.g. ESP8266 board).
+    Description attributes: "host" - host name or IP address, "port"
+    """
+
+    def __init__(self, description, io_loop, traffic_recorder=None, retry_connection_delay=10):
+        # (family, socket address) as resolved by self._resolve_address. Set before the base __init__ starts connecting
+        self.__address = None
+        super(SimpleTcpPeriphDev, self).__init__(description, io_loop, traffic_recorder, retry_connection_delay)
+
+    def _resolve_address(self):
+        # Resolved before each connection attempt as the address may change (e.g. DHCP)
+        family, _, _, _, address = socket.getaddrinfo(self.description['host'], self.description['port'],
+                                                      type=socket.SOCK_STREAM)[0]
+        self.__address = (family, address)
+
+    def _open_stream(self):
+        family, address = self.__address
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        # Messages are short, there is no point in delaying them
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        error = sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise OSError(error, os.strerror(error))
+        return sock
+
+    def _check_stream_opened(self, stream):
+        error = stream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            raise OSError(error, os.strerror(error))
+
+    def _read(self, stream):
+        try:
+            return stream.recv(self.max_read_size)
+        except BlockingIOError:
+            return None
+
+    def _write(self, stream, data):
+        try:
+            return stream.send(data)
+        except BlockingIOError:
+            return 0
+
+    def _close_stream(self, stream):
+        stream.close()
+
+
+# A transport is a function that creates a device:
+# create(description, io_loop, ble_adapter=None, traffic_recorder=None) -> SimplePeriphDev
+# and whether the device needs its own BLE adapter (pygatt Backend), which has to be created and started beforehand
+PeriphDevTransport = namedtuple('PeriphDevTransport', ['create', 'needs_ble_adapter'])
+# Peripheral device transports by device description "type" (see PeriphDevicesDescriptions.json). Only the devices of
+# the types registered here are supported
+periph_dev_transports = {}
+
+
+def register_transport(type_name, needs_ble_adapter=False):
+    """
+    Decorator. Registers a device creation function for devices with "type" type_name
+    """
+    def decorator(create):
+        periph_dev_transports[type_name] = PeriphDevTransport(create, needs_ble_adapter)
+        return create
+    return decorator
+
+
+@register_transport('BLE_serial_AT-09', needs_ble_adapter=True)
+def create_ble_periph_dev(description, io_loop, ble_adapter=None, traffic_recorder=None):
+    # BLE devices are served by pygatt's threads rather than io_loop
+    return SimpleBlePeriphDev(description=description, ble_adapter=ble_adapter, traffic_recorder=traffic_recorder)
+
+
+@register_transport('serial')
+def create_serial_periph_dev(description, io_loop, ble_adapter=None, traffic_recorder=None):
+    return SimpleSerialPeriphDev(description, io_loop, traffic_recorder=traffic_recorder)
+
+
+@register_transport('TCP')
+def create_tcp_periph_dev(description, io_loop, ble_adapter=None, traffic_recorder=None):
+    return SimpleTcpPeriphDev(description, io_loop, traffic_recorder=traffic_recorder)
@@ -0,0 +1,88 @@
+from SimplePeriphDev import SimplePeriphDev, register_transport
+import threading
+
+
+class SimulatedPeriphDev(SimplePeriphDev):
+    """
+    Peripheral device without any hardware behind it. Used to run a controller (or several of them behind a gateway,
+    see Gateway.py) on a development machine.
+    The device is online right away and speaks the same text protocol as the real ones: on 'STATE' it reports all its
+    parameters, initially the first state of each "bool" parameter and 0.0 of each "float" one. The i-th command of a
+    controllable "bool" parameter switches it to its i-th state. Readings of other parameters are made up with
+    self.simulate_reading.
+    Safe for use by multiple threads
+    """
+
+    def __init__(self, description, traffic_recorder=None):
+        super(SimulatedPeriphDev, self).__init__(description)
+        self.traffic_recorder = traffic_recorder
+        # "Hardware" state of the device, as opposed to self._parameters, which is what the controller has received
+        self.__state = {}
+        for curr_param in self.description['parameters']:
+            self.__state[curr_param['name']] = curr_param['states'][0] if curr_param['type'] == 'bool' else 0.0
+        # Guards self.__state. Also makes sure _handle_received_data is not called by multiple threads. Reentrant as a
+        # parameter update may make the controller send another command right away
+        self.__lock = threading.RLock()
+        self.online.set()
+        self._send_text('STATE')
+
+    def _send_text(self, text: str):
+        if not self.online.is_set():
+            raise self.Exceptions.NotConnectedError
+        if self.traffic_recorder is not None:
+            self.traffic_recorder.record_write(self, str.encode(text + ';', encoding='ASCII'))
+        # The state is only changed with the lock acquired
+        with self.__lock:
+            responses = []
+            for curr_message in text.split(';'):
+                if curr_message == 'STATE':
+                    responses += ['PRM:{}:{}'.format(curr_param, curr_value)
+                                  for curr_param, curr_value in self.__state.items()]
+                    continue
+                split_data = curr_message.split(':')
+                if len(split_data) != 3 or split_data[0] != 'PRM':
+                    responses.append('ERR:Invalid message format')
+                    continue
+                for curr_param in self.description['parameters']:
+                    if curr_param['name'] == split_data[1] and curr_param.get('controllable', False) and \
+                            split_data[2] in curr_param['commands']:
+                        new_state = curr_param['states'][curr_param['commands'].index(split_data[2])]
+                        # Real devices only report actual changes
+                        if self.__state[curr_param['name']] != new_state:
+                            self.__state[curr_param['name']] = new_state
+                            responses.append('PRM:{}:{}'.format(curr_param['name'], new_state))
+                        break
+                else:
+                    responses.append('ERR:Invalid command')
+            if responses:
+                self.__receive(';'.join(responses) + ';')
+
+    def _call_later(self, delay, callback, *args):
+        # Same as the data the device "sends", the callback is run with the lock acquired
+        super(SimulatedPeriphDev, self)._call_later(delay, self.__call_locked, callback, *args)
+
+    def __call_locked(self, callback, *args):
+        with self.__lock:
+            callback(*args)
+
+    def simulate_reading(self, parameter, value):
+        """
+        Makes the device report a new value of a parameter, as if it has been measured
+        """
+        with self.__lock:
+            self.__state[parameter] = value
+            self.__receive('PRM:{}:{};'.format(parameter, value))
+
+    def __receive(self, text):
+        raw_data = str.encode(text, encoding='ASCII')
+        if self.traffic_recorder is not None:
+            self.traffic_recorder.record_notification(self, raw_data)
+        self._handle_received_data(raw_data)
+
+    def __repr__(self):
+        return '{} simulated\t{}'.format(self.description['name'], 'online' if self.online.is_set() else 'offline')
+
+
+@register_transport('simulated')
+def create_simulated_periph_dev(description, io_loop, ble_adapter=None, traffic_recorder=None):
+    return SimulatedPeriphDev(description, traffic_recorder=traffic_recorder)
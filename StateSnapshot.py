@@ -0,0 +1,96 @@
+from threading import Thread
+import logging
+import json
+import time
+import os
+
+
+class StateSnapshotStore:
+    """
+    Periodically saves last known parameter values of the peripheral devices to a file, so that after a restart they
+    can be shown right away (flagged as stale) instead of waiting for each device to reconnect.
+    The file is replaced atomically and synced to the disk, so a power loss leaves either the previous or the new
+    snapshot, never a broken one. It is only rewritten when something has changed, to spare the SD card.
+    File format:
+    {"version":1,"devices":{"greenhouse":{"temperature":[21.1,1538239203.52],...},...}}
+    where each parameter has its value and the time (time.time()) it has been received from the device at
+    """
+    version = 1
+
+    def __init__(self, file_name, interval=60):
+        """
+        :param file_name: Snapshot file name
+        :param interval: Time between snapshots, in seconds
+        """
+        self.file_name = file_name
+        self.interval = interval
+        self.periph_devices = {}
+        self.__last_saved_data = None
+
+    def load(self):
+        """
+        :return: Parameters snapshot of each device (see SimplePeriphDev.get_parameters_snapshot) by device name. Empty
+        if there is no valid snapshot. Devices which snapshots are not objects are left out. The parameters' entries
+        are validated by SimplePeriphDev.restore_parameters
+        """
+        try:
+            with open(self.file_name) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.error('Could not load state snapshot "%s": %s', self.file_name, e)
+            return {}
+        if not isinstance(snapshot, dict) or snapshot.get('version', None) != self.version or \
+                not isinstance(snapshot.get('devices', None), dict):
+            logging.error('State snapshot "%s" has unsupported format', self.file_name)
+            return {}
+        devices_snapshots = {}
+        for curr_dev_name, curr_dev_snapshot in snapshot['devices'].items():
+            if isinstance(curr_dev_snapshot, dict):
+                devices_snapshots[curr_dev_name] = curr_dev_snapshot
+            else:
+                logging.error('State snapshot "%s": invalid snapshot of device "%s". Skipping it', self.file_name,
+                              curr_dev_name)
+        return devices_snapshots
+
+    def start(self, periph_devices):
+        """
+        Starts taking snapshots in a new daemon thread
+        :param periph_devices: Devices by name
+        :return:
+        """
+        self.periph_devices = periph_devices
+        thread = Thread(target=self.__run, name='StateSnapshotStore', daemon=True)
+        thread.start()
+
+    def __run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save()
+            except OSError as e:
+                logging.error('Could not save state snapshot "%s": %s', self.file_name, e)
+
+    def save(self):
+        snapshot = {
+            'version': self.version,
+            'devices': {curr_dev_name: curr_dev.get_parameters_snapshot()
+                        for curr_dev_name, curr_dev in self.periph_devices.items()}
+        }
+        data = json.dumps(snapshot, separators=(',', ':'))
+        if data == self.__last_saved_data:
+            return
+        temp_file_name = self.file_name + '.tmp'
+        with open(temp_file_name, 'w') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_file_name, self.file_name)
+        # Making the rename itself durable
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.file_name)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.__last_saved_data = data
@@ -0,0 +1,307 @@
+from SimplePeriphDev import SimplePeriphDev, SimpleBlePeriphDev, periph_dev_transports
+from Controller import Controller
+from threading import Event, Lock
+import functools
+import argparse
+import pygatt
+import logging
+import json
+import gzip
+import time
+
+
+class TraceEventTypes:
+    # Raw notification chunk received from the device (one __handle_notification call)
+    NOTIFICATION = 'n'
+    # Text written to the device
+    WRITE = 'w'
+    CONNECT = 'c'
+    DISCONNECT = 'd'
+
+
+def open_trace_file(file_name, mode):
+    """
+    Trace files which names end with '.gz' are compressed
+    :param mode: 'r' or 'w'
+    """
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, mode + 't', encoding='ASCII')
+    return open(file_name, mode, encoding='ASCII')
+
+
+class TrafficRecorder:
+    """
+    Records peripheral devices' traffic into a trace file so that it can be replayed later by TrafficReplayer.
+    Trace file format: JSON value per line. The first line is the header:
+    {"version": 1, "time": 1538239203.52, "devices": [<device description>, ...]}
+    Other lines are events:
+    [<seconds since recording start>, <device name>, <event type (see TraceEventTypes)>[, <data>]]
+    Sample:
+    [0.0012,"greenhouse","c"]
+    [0.0571,"greenhouse","w","STATE;"]
+    [0.3102,"greenhouse","n","PRM:temperature:2"]
+    [0.3311,"greenhouse","n","1.1;PRM:window:closed;"]
+    Safe for use by multiple threads
+    """
+    version = 1
+
+    def __init__(self, file_name, devices_descriptions):
+        """
+        :param file_name: Trace file name. Compressed if ends with '.gz'
+        :param devices_descriptions: Descriptions of the devices which traffic is going to be recorded
+        """
+        self.__lock = Lock()
+        self.__file = open_trace_file(file_name, 'w')
+        self.__start_time = time.monotonic()
+        self.__write_line({'version': self.version, 'time': time.time(), 'devices': devices_descriptions})
+
+    def __write_line(self, value):
+        with self.__lock:
+            self.__file.write(json.dumps(value, separators=(',', ':')) + '\n')
+            # Not losing the trace of a field issue if the controller crashes
+            self.__file.flush()
+
+    def record(self, device, event_type, data=None):
+        event = [round(time.monotonic() - self.__start_time, 4), str(device), event_type]
+        if data is not None:
+            event.append(data)
+        self.__write_line(event)
+
+    def record_notification(self, device, raw_data: bytes):
+        # Raw data is not necessarily valid ASCII. latin-1 maps each byte to one character and back
+        self.record(device, TraceEventTypes.NOTIFICATION, raw_data.decode('latin-1'))
+
+    def record_write(self, device, data: bytes):
+        self.record(device, TraceEventTypes.WRITE, data.decode('latin-1'))
+
+    def record_connect(self, device):
+        self.record(device, TraceEventTypes.CONNECT)
+
+    def record_disconnect(self, device):
+        self.record(device, TraceEventTypes.DISCONNECT)
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+def read_trace(file_name):
+    """
+    :return: (header, events) (see TrafficRecorder)
+    """
+    with open_trace_file(file_name, 'r') as trace_file:
+        header = json.loads(trace_file.readline())
+        events = [json.loads(curr_line) for curr_line in trace_file if curr_line.strip()]
+    return header, events
+
+
+class ReplayBleConnection:
+    """
+    Stands in for a pygatt device connection. Notifications are fed to the subscribed callback by TrafficReplayer
+    """
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.notification_callback = None
+        self.writes_count = 0
+
+    def subscribe(self, uuid, callback=None, indication=False):
+        self.notification_callback = callback
+
+    def char_write(self, uuid, value, wait_for_response=False):
+        if not self.adapter.link_up.is_set():
+            raise pygatt.exceptions.NotConnectedError()
+        self.writes_count += 1
+
+
+class ReplayBleAdapter:
+    """
+    Stands in for pygatt backend. The replayed device can only connect while the link is up according to the trace
+    """
+
+    def __init__(self):
+        self.link_up = Event()
+        self.connection = ReplayBleConnection(self)
+
+    def connect(self, address, timeout=None):
+        if not self.link_up.wait(timeout):
+            raise pygatt.exceptions.NotConnectedError()
+        return self.connection
+
+
+class ReplayPeriphDev(SimplePeriphDev):
+    """
+    Stands in for the devices of the transports other than BLE (e.g. serial, TCP, see
+    SimplePeriphDev.periph_dev_transports). They share the message parser with the BLE ones, so the recorded data is fed
+    right into it by TrafficReplayer
+    """
+
+    def __init__(self, description):
+        super(ReplayPeriphDev, self).__init__(description)
+        self.writes_count = 0
+
+    def _send_text(self, text: str):
+        if not self.online.is_set():
+            raise self.Exceptions.NotConnectedError
+        self.writes_count += 1
+
+    def handle_connect(self):
+        # Same as stream devices do on connect (see SimpleStreamPeriphDev)
+        self._message_buffer = ''
+        self.online.set()
+        self._send_text('STATE')
+
+    def handle_disconnect(self):
+        self.online.clear()
+
+
+class TrafficReplayer:
+    """
+    Feeds a recorded trace (see TrafficRecorder) into SimpleBlePeriphDev instances (and a Controller) in place of
+    real BLE devices and measures how fast the traffic is processed. Devices of other transports are replayed by
+    ReplayPeriphDev.
+    Recorded writes are not replayed - the writes are made by the replayed devices and the controller themselves and
+    are counted instead. A BLE device notices a disconnect the same way it does with a real BLE device, that is when
+    it tries to write to it.
+    """
+
+    def __init__(self, trace_file_name, controller_config_file_name=None, speed=1.0):
+        """
+        :param controller_config_file_name: If specified, devices are connected to a Controller, which means the
+        automation logic is run on every update
+        :param speed: Replay speed relative to the recorded one. 0 means as fast as possible
+        """
+        self.header, self.events = read_trace(trace_file_name)
+        self.speed = speed
+        self.adapters = {}
+        self.devices = {}
+        self.published_updates_count = 0
+        self.raw_readings_count = 0
+        for curr_dev_descr in self.header['devices']:
+            # If the recording was started after the device had connected, it has to be connected from the start
+            curr_dev_events = [curr_event for curr_event in self.events if curr_event[1] == curr_dev_descr['name']]
+            connected = bool(curr_dev_events) and curr_dev_events[0][2] != TraceEventTypes.CONNECT
+            transport = periph_dev_transports.get(curr_dev_descr['type'], None)
+            if transport is not None and transport.needs_ble_adapter:
+                curr_adapter = ReplayBleAdapter()
+                if connected:
+                    curr_adapter.link_up.set()
+                self.adapters[curr_dev_descr['name']] = curr_adapter
+                curr_dev = SimpleBlePeriphDev(description=curr_dev_descr, ble_adapter=curr_adapter)
+            else:
+                curr_dev = ReplayPeriphDev(curr_dev_descr)
+                if connected:
+                    curr_dev.handle_connect()
+            curr_dev.raw_parameter_updated_callback = self.__handle_raw_reading
+            curr_dev.parameter_updated_callback = self.__handle_published_update
+            self.devices[curr_dev_descr['name']] = curr_dev
+        self.controller = None
+        if controller_config_file_name is not None:
+            self.controller = Controller(self.devices, self.header['devices'], controller_config_file_name)
+            self.controller.update_callback = self.__handle_published_update
+
+    def __handle_raw_reading(self, device, parameter, value):
+        self.raw_readings_count += 1
+
+    def __handle_published_update(self, *args, **kwargs):
+        self.published_updates_count += 1
+
+    def __wait_online(self, device_name, timeout=5):
+        if not self.devices[device_name].online.wait(timeout):
+            logging.warning('Replayed device %s did not connect', device_name)
+
+    def run(self):
+        """
+        Replays the trace. Blocks until it is finished
+        :return: Report dictionary
+        """
+        notifications_count = 0
+        notifications_bytes = 0
+        recorded_writes_count = 0
+        # Time spent in notification handlers (parsing, automation logic) for each notification
+        processing_times = []
+        # Devices that have been connected from the start
+        for curr_dev_name, curr_adapter in self.adapters.items():
+            if curr_adapter.link_up.is_set():
+                self.__wait_online(curr_dev_name)
+        start_time = time.perf_counter()
+        for curr_event in self.events:
+            event_time, device_name, event_type = curr_event[0:3]
+            if self.speed > 0:
+                delay = start_time + event_time / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            device = self.devices.get(device_name, None)
+            if device is None:
+                continue
+            # None for the devices replayed by ReplayPeriphDev
+            adapter = self.adapters.get(device_name, None)
+            if event_type == TraceEventTypes.NOTIFICATION:
+                if adapter is not None:
+                    callback = adapter.connection.notification_callback
+                    if callback is None:
+                        logging.warning('Replayed device %s is not subscribed. Notification skipped', device_name)
+                        continue
+                    handle_data = functools.partial(callback, SimpleBlePeriphDev.bleModuleSerialCharHandle)
+                else:
+                    handle_data = device._handle_received_data
+                raw_data = curr_event[3].encode('latin-1')
+                notifications_count += 1
+                notifications_bytes += len(raw_data)
+                processing_start_time = time.perf_counter()
+                handle_data(raw_data)
+                processing_times.append(time.perf_counter() - processing_start_time)
+            elif event_type == TraceEventTypes.WRITE:
+                recorded_writes_count += 1
+            elif event_type == TraceEventTypes.CONNECT:
+                if adapter is not None:
+                    adapter.link_up.set()
+                    self.__wait_online(device_name)
+                else:
+                    device.handle_connect()
+            elif event_type == TraceEventTypes.DISCONNECT:
+                if adapter is not None:
+                    adapter.link_up.clear()
+                else:
+                    device.handle_disconnect()
+        wall_time = time.perf_counter() - start_time
+        processing_times.sort()
+        processing_time = sum(processing_times)
+        return {
+            'trace_duration': self.events[-1][0] if self.events else 0.0,
+            'wall_time': wall_time,
+            'events': len(self.events),
+            'notifications': notifications_count,
+            'notifications_bytes': notifications_bytes,
+            'raw_readings': self.raw_readings_count,
+            'published_updates': self.published_updates_count,
+            'recorded_writes': recorded_writes_count,
+            'replayed_writes': sum(curr_adapter.connection.writes_count for curr_adapter in self.adapters.values()) +
+                               sum(curr_dev.writes_count for curr_dev in self.devices.values()
+                                   if isinstance(curr_dev, ReplayPeriphDev)),
+            'processing_time': processing_time,
+            'notifications_per_second': notifications_count / processing_time if processing_time else 0.0,
+            'mean_processing_time': processing_time / len(processing_times) if processing_times else 0.0,
+            'p95_processing_time': processing_times[int(len(processing_times) * 0.95)] if processing_times else 0.0,
+            'max_processing_time': processing_times[-1] if processing_times else 0.0
+        }
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Replays a recorded device traffic trace and reports processing '
+                                                     'throughput and timing')
+    arg_parser.add_argument('trace_file_name')
+    arg_parser.add_argument('--speed', type=float, default=1.0,
+                            help='Replay speed relative to the recorded one. 0 means as fast as possible')
+    arg_parser.add_argument('--controller-config', default='controller_config.json',
+                            help='Controller config file name')
+    arg_parser.add_argument('--no-controller', action='store_true',
+                            help='Only replay the devices, without automation logic')
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    replayer = TrafficReplayer(args.trace_file_name, None if args.no_controller else args.controller_config,
+                               args.speed)
+    report = replayer.run()
+    for curr_key, curr_value in report.items():
+        print('{}: {}'.format(curr_key, curr_value))
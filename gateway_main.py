@@ -0,0 +1,29 @@
+from Gateway import GatewayHTTPServer
+import json
+import logging
+
+# Configuration variables
+retry_connection_delay = 10  # In seconds
+gateway_config_file_name = 'gateway_config.json'
+http_server_address = ('', 3229)
+# A template for the main page file name. There will be different pages for different locales.
+# Resulting name examples (for template 'gateway_index'): gateway_index_ru.html, gateway_index_en.html
+main_page_file_name_template = 'HTTPServerData/gateway_index'
+# File name of the page main template
+main_page_template_file_name = 'HTTPServerData/template_index.html'
+favicon_file_name = 'HTTPServerData/favicon.ico'
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logging.logProcesses = 0
+
+    # Reading upstream controllers' (sites') information from the configuration file
+    with open(gateway_config_file_name) as gateway_config_file:
+        sites_config = json.load(gateway_config_file)
+
+    http_server = GatewayHTTPServer(http_server_address, sites_config, main_page_file_name_template,
+                                    main_page_template_file_name, favicon_file_name, retry_connection_delay)
+    http_server.start_upstreams()
+    logging.info('Running gateway HTTP server')
+    http_server.serve_forever()
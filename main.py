@@ -1,4 +1,6 @@
-from SimplePeriphDev import SimpleBlePeriphDev
+from SimplePeriphDev import periph_dev_transports
+# Registers the 'simulated' transport
+import SimulatedPeriphDev
 import json
 import logging
 import time
@@ -7,6 +9,9 @@ import threading
 from HttpServer import CustomHTTPServer
 from jinja2 import Template
 from Controller import Controller
+from TrafficTrace import TrafficRecorder
+from IOLoop import IOLoop
+from StateSnapshot import StateSnapshotStore
 
 # Configuration variables
 retry_connection_delay = 10  # In seconds
@@ -21,6 +26,15 @@ main_page_file_name_template = 'HTTPServerData/index'
 main_page_template_file_name = 'HTTPServerData/template_index.html'
 favicon_file_name = 'HTTPServerData/favicon.ico'
 controller_config_file_name = 'controller_config.json'
+# If not None, all the peripheral devices' traffic is recorded to this file (see TrafficTrace.py). It can then be
+# replayed with 'python TrafficTrace.py <file name>'. Compressed if the name ends with '.gz'
+traffic_trace_file_name = None
+# Last known parameter values are saved to this file, so that they can be shown right after a restart
+state_snapshot_file_name = 'state_snapshot.json'
+state_snapshot_interval = 60  # In seconds
+# If True, all the peripheral devices are replaced with simulated ones (see SimulatedPeriphDev.py), e.g. to try the
+# controller or the gateway out without any hardware
+simulate_periph_devices = False
 
 
 def run_http_server():
@@ -36,6 +50,18 @@ if __name__ == '__main__':
     # Reading peripheral devices' information from the configuration file
     with open(periph_devices_descriptions_filename) as periphDevDescrFile:
         periph_devices_descriptions = json.load(periphDevDescrFile)
+    if simulate_periph_devices:
+        for curr_device_descr in periph_devices_descriptions:
+            curr_device_descr['type'] = 'simulated'
+    # Devices of unsupported types are left out altogether, they are not even shown on the main page
+    supported_devices_descriptions = []
+    for curr_device_descr in periph_devices_descriptions:
+        if curr_device_descr['type'] in periph_dev_transports:
+            supported_devices_descriptions.append(curr_device_descr)
+        else:
+            logging.error('Device "%s" has unsupported type "%s". Skipping it', curr_device_descr['name'],
+                          curr_device_descr['type'])
+    periph_devices_descriptions = supported_devices_descriptions
 
     # Forming the main page from template
     template = Template(open(main_page_template_file_name).read())
@@ -51,22 +77,34 @@ if __name__ == '__main__':
     # Connecting to the peripheral devices
     # All the peripheral devices
     periph_devices = {}
-    ble_adapters = []
+    # BLE adapters by device name
+    ble_adapters = {}
     # Note: for some reason if there's an adapter that has been already connected to a device, starting another adapter
     # will disconnect it. First starting two adapters and connecting devices after that does not behave like that.
     # !!!Bug report?
     # creating and starting adapters
     for curr_device_descr in periph_devices_descriptions:
-        if curr_device_descr['type'] == 'BLE_serial_AT-09':
+        if periph_dev_transports[curr_device_descr['type']].needs_ble_adapter:
             # One adapter per each BLE peripheral device (don't mix up with hci0, hci1 etc)
             curr_ble_adapter = pygatt.GATTToolBackend()
             curr_ble_adapter.start()
-            ble_adapters.append(curr_ble_adapter)
-    # Connecting devices to created adapters
-    for i in range(0, len(ble_adapters)):
-        new_ble_periph_device = SimpleBlePeriphDev(description=periph_devices_descriptions[i],
-                                                   ble_adapter=ble_adapters[i])
-        periph_devices[periph_devices_descriptions[i]['name']] = new_ble_periph_device
+            ble_adapters[curr_device_descr['name']] = curr_ble_adapter
+    traffic_recorder = None
+    if traffic_trace_file_name is not None:
+        traffic_recorder = TrafficRecorder(traffic_trace_file_name, periph_devices_descriptions)
+    # Last known parameter values. Given to the devices as soon as they are created, before they connect
+    state_snapshot_store = StateSnapshotStore(state_snapshot_file_name, state_snapshot_interval)
+    state_snapshot = state_snapshot_store.load()
+    # Serial and TCP devices' I/O is performed by this loop's thread
+    io_loop = IOLoop()
+    io_loop.start()
+    # Creating devices according to their types. BLE devices are connected to the created adapters
+    for curr_device_descr in periph_devices_descriptions:
+        periph_devices[curr_device_descr['name']] = periph_dev_transports[curr_device_descr['type']].create(
+            curr_device_descr, io_loop, ble_adapter=ble_adapters.get(curr_device_descr['name'], None),
+            traffic_recorder=traffic_recorder)
+        periph_devices[curr_device_descr['name']].restore_parameters(state_snapshot.get(curr_device_descr['name'], {}))
+    state_snapshot_store.start(periph_devices)
 
     # Controller init
     controller = Controller(periph_devices, periph_devices_descriptions, controller_config_file_name)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules are not packaged. They are imported from the repository root, the way main.py imports them
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
@@ -0,0 +1,33 @@
+from SimplePeriphDev import SimpleBlePeriphDev
+from TrafficTrace import ReplayBleAdapter
+import time
+
+description = {
+    'name': 'greenhouse',
+    'type': 'BLE_serial_AT-09',
+    'MAC': 'E0:E5:CF:78:70:5C',
+    'parameters': [
+        {'name': 'window', 'type': 'bool', 'controllable': True, 'states': ['closed', 'opened'],
+         'commands': ['Close', 'Open']},
+        {'name': 'lights', 'type': 'bool', 'controllable': True, 'states': ['off', 'on'],
+         'commands': ['turn_off', 'turn_on']}
+    ]
+}
+
+
+def test_long_text_is_written_by_parts():
+    adapter = ReplayBleAdapter()
+    writes = []
+    adapter.connection.char_write = lambda uuid, value, wait_for_response=False: writes.append(value)
+    adapter.link_up.set()
+    device = SimpleBlePeriphDev(description, adapter)
+    assert device.online.wait(5)
+    # Waiting for the state request
+    deadline = time.monotonic() + 5
+    while not writes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writes == [b'STATE;']
+    writes.clear()
+    assert device.send_commands([('window', 'Open'), ('lights', 'turn_on')])
+    assert writes == [b'PRM:window:Open;PRM:', b'lights:turn_on;']
+    assert all(len(curr_part) <= SimpleBlePeriphDev.bleModuleMaxWriteLength for curr_part in writes)
@@ -0,0 +1,74 @@
+from http.client import HTTPConnection
+from threading import Thread
+from HttpServer import CustomHTTPServer
+from Controller import Controller
+from SimulatedPeriphDev import SimulatedPeriphDev
+import pytest
+import json
+import os
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def controller():
+    with open(os.path.join(repo_dir, 'PeriphDevicesDescriptions.json')) as descriptions_file:
+        descriptions = json.load(descriptions_file)
+    periph_devices = {curr_descr['name']: SimulatedPeriphDev(curr_descr) for curr_descr in descriptions}
+    controller = Controller(periph_devices, descriptions, os.path.join(repo_dir, 'controller_config.json'))
+    controller.update_callback = lambda update_data: None
+    controller.error_callback = lambda message: None
+    return controller
+
+
+def test_commands_are_executed(controller):
+    valid, errors = controller.handle_user_command(json.dumps([
+        {'target': 'greenhouse', 'parameter': 'window', 'command': 'Open'},
+        {'target': 'greenhouse', 'parameter': 'lights', 'command': 'turn_on'},
+        {'target': 'well_and_tank', 'parameter': 'pump', 'command': 'turn_on'}
+    ]))
+    assert (valid, errors) == (True, [])
+    assert controller.periph_devices['greenhouse'].parameters['window'] == 'opened'
+    assert controller.periph_devices['greenhouse'].parameters['lights'] == 'on'
+    assert controller.periph_devices['well_and_tank'].parameters['pump'] == 'on'
+
+
+@pytest.mark.parametrize('command', [
+    {'target': ['greenhouse'], 'parameter': 'window', 'command': 'Open'},
+    {'target': 'greenhouse', 'parameter': {'name': 'window'}, 'command': 'Open'},
+    {'target': 'greenhouse', 'parameter': 'window', 'command': 1},
+    {'target': 'controller', 'parameter': 'pump_auto_control', 'command': 'true'},
+    {'target': 'greenhouse', 'parameter': 'temperature', 'command': 'Open'},
+    'Open'
+])
+def test_invalid_command_cancels_all(controller, command):
+    valid, errors = controller.handle_user_command(json.dumps([
+        {'target': 'greenhouse', 'parameter': 'lights', 'command': 'turn_on'},
+        command
+    ]))
+    assert not valid
+    assert len(errors) == 1
+    assert controller.periph_devices['greenhouse'].parameters['lights'] == 'off'
+
+
+def test_offline_device_is_reported(controller, tmp_path):
+    server = CustomHTTPServer(('127.0.0.1', 0), str(tmp_path / 'index'),
+                              os.path.join(repo_dir, 'HTTPServerData', 'favicon.ico'), controller)
+    server.user_command_callback = controller.handle_user_command
+    Thread(target=server.serve_forever, daemon=True).start()
+    controller.periph_devices['well_and_tank'].online.clear()
+    conn = HTTPConnection(*server.server_address, timeout=10)
+    conn.request('POST', '/command', json.dumps([
+        {'target': 'greenhouse', 'parameter': 'lights', 'command': 'turn_on'},
+        {'target': 'well_and_tank', 'parameter': 'pump', 'command': 'turn_on'}
+    ]))
+    response = conn.getresponse()
+    # The commands are valid, the device is unreachable
+    assert response.status == 503
+    assert json.loads(response.read()) == \
+        {'errors': ['Device well_and_tank is offline, its commands have not been executed']}
+    conn.close()
+    server.shutdown()
+    server.server_close()
+    # The other devices' commands are executed anyway
+    assert controller.periph_devices['greenhouse'].parameters['lights'] == 'on'
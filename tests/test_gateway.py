@@ -0,0 +1,197 @@
+from http.client import HTTPConnection
+from threading import Thread
+from HttpServer import CustomHTTPServer
+from Gateway import GatewayHTTPServer, UpstreamConnectionPool
+from http.client import HTTPException
+from Controller import Controller
+from SimulatedPeriphDev import SimulatedPeriphDev
+import pytest
+import json
+import time
+import socket
+import os
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+favicon_file_name = os.path.join(repo_dir, 'HTTPServerData', 'favicon.ico')
+main_page_template_file_name = os.path.join(repo_dir, 'HTTPServerData', 'template_index.html')
+
+
+def start_server(server):
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_site(tmp_path, name):
+    with open(os.path.join(repo_dir, 'PeriphDevicesDescriptions.json')) as descriptions_file:
+        descriptions = json.load(descriptions_file)
+    periph_devices = {curr_descr['name']: SimulatedPeriphDev(curr_descr) for curr_descr in descriptions}
+    controller = Controller(periph_devices, descriptions, os.path.join(repo_dir, 'controller_config.json'))
+    server = CustomHTTPServer(('127.0.0.1', 0), str(tmp_path / name), favicon_file_name, controller)
+    controller.update_callback = server.parameter_update_handler
+    server.user_command_callback = controller.handle_user_command
+    return start_server(server)
+
+
+def request(server, method, path, body=None):
+    conn = HTTPConnection(*server.server_address, timeout=10)
+    try:
+        conn.request(method, path, body)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def gateway_device(gateway, name):
+    _, state = request(gateway, 'GET', '/initial_data')
+    return {curr_dev['name']: curr_dev for curr_dev in state['devices']}[name]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            pytest.fail('Timed out')
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def gateway_and_sites(tmp_path):
+    sites = {'plot_1': start_site(tmp_path, 'plot_1'), 'plot_2': start_site(tmp_path, 'plot_2')}
+    sites_config = [{'name': curr_name, 'host': curr_site.server_address[0], 'port': curr_site.server_address[1]}
+                    for curr_name, curr_site in sites.items()]
+    gateway = GatewayHTTPServer(('127.0.0.1', 0), sites_config, str(tmp_path / 'gateway_index'),
+                                main_page_template_file_name, favicon_file_name, retry_connection_delay=0.1)
+    start_server(gateway)
+    gateway.start_upstreams()
+    wait_for(lambda: all(curr_site.online and curr_site.descriptions is not None
+                         for curr_site in gateway.sites.values()))
+    yield gateway, sites
+    for curr_server in [gateway] + list(sites.values()):
+        curr_server.shutdown()
+        curr_server.server_close()
+
+
+def test_initial_data_merges_sites(gateway_and_sites):
+    gateway, sites = gateway_and_sites
+    status, state = request(gateway, 'GET', '/initial_data')
+    assert status == 200
+    devices = {curr_dev['name']: curr_dev for curr_dev in state['devices']}
+    assert set(devices) == {'plot_1/well_and_tank', 'plot_1/greenhouse', 'plot_2/well_and_tank', 'plot_2/greenhouse'}
+    assert devices['plot_2/greenhouse']['site'] == 'plot_2'
+    assert devices['plot_2/greenhouse']['online']
+    assert devices['plot_2/greenhouse']['parameters']['window'] == 'closed'
+    assert set(state['controller_config']) == {'plot_1', 'plot_2'}
+    status, descriptions = request(gateway, 'GET', '/descriptions')
+    assert status == 200
+    assert 'plot_1/greenhouse' in [curr_descr['name'] for curr_descr in descriptions]
+
+
+def test_updates_are_namespaced(gateway_and_sites):
+    gateway, sites = gateway_and_sites
+    _, state = request(gateway, 'GET', '/initial_data')
+    sites['plot_2'].controller.periph_devices['well_and_tank'].simulate_reading('well_water_presence', 'present')
+    last_update_time = state['time']
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        status, update = request(gateway, 'POST', '/updates', str(last_update_time))
+        assert status == 200
+        last_update_time = update['time']
+        devices = {curr_dev['name']: curr_dev for curr_dev in update['devices']}
+        if 'plot_2/well_and_tank' in devices and \
+                devices['plot_2/well_and_tank']['parameters'].get('well_water_presence') == 'present':
+            assert 'plot_1/well_and_tank' not in devices
+            break
+    else:
+        pytest.fail('The update has not been forwarded')
+
+
+def test_commands_are_routed_to_sites(gateway_and_sites):
+    gateway, sites = gateway_and_sites
+    status, response = request(gateway, 'POST', '/command', json.dumps([
+        {'target': 'plot_1/greenhouse', 'parameter': 'lights', 'command': 'turn_on'},
+        {'target': 'plot_2/greenhouse', 'parameter': 'window', 'command': 'Open'}
+    ]))
+    assert (status, response) == (200, {'errors': []})
+    assert sites['plot_1'].controller.periph_devices['greenhouse'].parameters['lights'] == 'on'
+    assert sites['plot_1'].controller.periph_devices['greenhouse'].parameters['window'] == 'closed'
+    assert sites['plot_2'].controller.periph_devices['greenhouse'].parameters['window'] == 'opened'
+    assert sites['plot_2'].controller.periph_devices['greenhouse'].parameters['lights'] == 'off'
+    # The sites' updates come back through the gateway
+    wait_for(lambda: gateway_device(gateway, 'plot_1/greenhouse')['parameters']['lights'] == 'on')
+
+
+def test_invalid_command_target(gateway_and_sites):
+    gateway, sites = gateway_and_sites
+    status, response = request(gateway, 'POST', '/command', json.dumps([
+        {'target': 'plot_1/greenhouse', 'parameter': 'lights', 'command': 'turn_on'},
+        {'target': 'plot_3/greenhouse', 'parameter': 'lights', 'command': 'turn_on'}
+    ]))
+    assert status == 400
+    assert response['errors'] == ['No such site: plot_3']
+    # None of the commands is forwarded
+    assert sites['plot_1'].controller.periph_devices['greenhouse'].parameters['lights'] == 'off'
+
+
+
+def test_offline_device_command(gateway_and_sites):
+    gateway, sites = gateway_and_sites
+    sites['plot_2'].controller.periph_devices['greenhouse'].online.clear()
+    status, response = request(gateway, 'POST', '/command', json.dumps([
+        {'target': 'plot_1/greenhouse', 'parameter': 'lights', 'command': 'turn_on'},
+        {'target': 'plot_2/greenhouse', 'parameter': 'lights', 'command': 'turn_on'}
+    ]))
+    # The commands are valid, a device is unreachable
+    assert status == 503
+    assert response['errors'] == ['plot_2: Device greenhouse is offline, its commands have not been executed']
+    assert sites['plot_1'].controller.periph_devices['greenhouse'].parameters['lights'] == 'on'
+
+class DroppingUpstream:
+    """
+    Answers the first request on each connection and drops the connection on the second one without answering, the
+    way an upstream that has executed a request and then lost the connection looks to the client
+    """
+
+    def __init__(self):
+        self.listening_socket = socket.socket()
+        self.listening_socket.bind(('127.0.0.1', 0))
+        self.listening_socket.listen(4)
+        self.requests = []
+        Thread(target=self.__run, daemon=True).start()
+
+    def __run(self):
+        while True:
+            conn, _ = self.listening_socket.accept()
+            with conn, conn.makefile('rb') as conn_file:
+                for curr_request_index in range(2):
+                    request_line = conn_file.readline().decode('ASCII')
+                    if not request_line:
+                        # Closed by the client
+                        break
+                    content_length = 0
+                    for curr_line in iter(conn_file.readline, b'\r\n'):
+                        name, value = curr_line.decode('ASCII').split(':', 1)
+                        if name.lower() == 'content-length':
+                            content_length = int(value)
+                    conn_file.read(content_length)
+                    self.requests.append(request_line.split()[0])
+                    if curr_request_index == 0:
+                        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}')
+
+
+def test_pool_retries_idempotent_request():
+    upstream = DroppingUpstream()
+    pool = UpstreamConnectionPool(*upstream.listening_socket.getsockname())
+    assert pool.request('GET', '/initial_data') == (200, b'{}')
+    # Dropped on the reused connection, performed again on a new one
+    assert pool.request('GET', '/initial_data') == (200, b'{}')
+    assert upstream.requests == ['GET', 'GET', 'GET']
+
+
+def test_pool_does_not_retry_command():
+    upstream = DroppingUpstream()
+    pool = UpstreamConnectionPool(*upstream.listening_socket.getsockname())
+    assert pool.request('GET', '/initial_data') == (200, b'{}')
+    with pytest.raises((ConnectionError, HTTPException)):
+        pool.request('POST', '/command', '{}')
+    assert upstream.requests == ['GET', 'POST']
@@ -0,0 +1,71 @@
+from http.client import HTTPConnection
+from threading import Thread
+from HttpServer import CustomHTTPServer
+from Controller import Controller
+from SimulatedPeriphDev import SimulatedPeriphDev
+import pytest
+import json
+import os
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def server(tmp_path):
+    with open(os.path.join(repo_dir, 'PeriphDevicesDescriptions.json')) as descriptions_file:
+        descriptions = json.load(descriptions_file)
+    periph_devices = {curr_descr['name']: SimulatedPeriphDev(curr_descr) for curr_descr in descriptions}
+    controller = Controller(periph_devices, descriptions, os.path.join(repo_dir, 'controller_config.json'))
+    server = CustomHTTPServer(('127.0.0.1', 0), str(tmp_path / 'index'),
+                              os.path.join(repo_dir, 'HTTPServerData', 'favicon.ico'), controller)
+    controller.update_callback = server.parameter_update_handler
+    server.user_command_callback = controller.handle_user_command
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def assert_keep_alive(response):
+    assert response.status == 200
+    assert response.getheader('Connection') == 'keep-alive'
+    assert int(response.getheader('Content-Length')) == len(response.read())
+
+
+def test_connection_is_persistent(server):
+    conn = HTTPConnection(*server.server_address, timeout=10)
+    conn.request('GET', '/initial_data')
+    assert_keep_alive(conn.getresponse())
+    sock = conn.sock
+    conn.request('POST', '/command', json.dumps({'target': 'greenhouse', 'parameter': 'lights', 'command': 'turn_on'}))
+    assert_keep_alive(conn.getresponse())
+    # The command has produced an update
+    conn.request('POST', '/updates', '0')
+    response = conn.getresponse()
+    assert response.status == 200
+    assert response.getheader('Connection') == 'keep-alive'
+    update = json.loads(response.read())
+    assert update['devices'][0]['parameters'] == {'lights': 'on'}
+    assert conn.sock is sock
+    conn.close()
+
+
+def test_post_without_content_length(server):
+    conn = HTTPConnection(*server.server_address, timeout=10)
+    conn.putrequest('POST', '/updates')
+    conn.endheaders()
+    response = conn.getresponse()
+    assert response.status == 411
+    response.read()
+    conn.close()
+
+
+def test_unknown_post_path_closes_connection(server):
+    conn = HTTPConnection(*server.server_address, timeout=10)
+    conn.request('POST', '/unknown', 'data')
+    response = conn.getresponse()
+    assert response.status == 400
+    assert response.getheader('Connection') == 'close'
+    response.read()
+    # The unread body would be taken for the next request otherwise
+    assert conn.sock is None
@@ -0,0 +1,124 @@
+from ParameterFilter import ParameterFilter
+from SimulatedPeriphDev import SimulatedPeriphDev
+from SimplePeriphDev import SimpleTcpPeriphDev
+from IOLoop import IOLoop
+from threading import Event, current_thread
+import pytest
+import socket
+
+
+@pytest.mark.parametrize('filter_description', [
+    {'averaging': 0},
+    {'averaging': 1.5},
+    {'deadband': -1},
+    {'min_interval': '10'},
+    {'relative_deadband': True},
+    {'dead_band': 0.3},
+    # The average would be stuck until the next reading
+    {'averaging': 3},
+    [0.3]
+])
+def test_invalid_description(filter_description):
+    with pytest.raises(ValueError):
+        ParameterFilter(filter_description)
+
+
+def test_deadband():
+    parameter_filter = ParameterFilter({'deadband': 0.3})
+    assert parameter_filter.filter(21.1, 0) == 21.1
+    assert parameter_filter.filter(21.3, 1) is None
+    assert parameter_filter.filter(21.5, 2) == 21.5
+    assert not parameter_filter.pending
+
+
+def test_suppressed_change_is_flushed():
+    parameter_filter = ParameterFilter({'deadband': 0.3, 'min_interval': 10})
+    assert parameter_filter.filter(21.1, 0) == 21.1
+    assert parameter_filter.filter(30.0, 5) is None
+    assert parameter_filter.pending
+    assert parameter_filter.next_publish_time == 10
+    assert parameter_filter.flush(10) == 30.0
+    assert not parameter_filter.pending
+
+
+def test_average_reaches_latest_reading():
+    parameter_filter = ParameterFilter({'deadband': 0.3, 'min_interval': 10, 'averaging': 3})
+    assert parameter_filter.filter(21.1, 0) == 21.1
+    assert parameter_filter.filter(21.1, 1) is None
+    # The sensor only reports changes, no more readings come
+    assert parameter_filter.filter(30.0, 5) is None
+    published_values = []
+    timestamp = 5
+    while parameter_filter.pending:
+        timestamp = parameter_filter.next_publish_time
+        published_values.append(parameter_filter.flush(timestamp))
+    assert published_values == [pytest.approx(27.033, abs=0.001), 30.0]
+    assert timestamp == 20
+
+
+def test_device_publishes_suppressed_reading():
+    description = {
+        'name': 'greenhouse',
+        'type': 'simulated',
+        'parameters': [{'name': 'temperature', 'type': 'float', 'controllable': False,
+                        'filter': {'deadband': 0.3, 'min_interval': 0.1}}]
+    }
+    device = SimulatedPeriphDev(description)
+    published = Event()
+    published_values = []
+
+    def handle_update(device, parameter, value):
+        published_values.append(value)
+        published.set()
+
+    device.parameter_updated_callback = handle_update
+    device.simulate_reading('temperature', 25.0)
+    assert published.wait(5)
+    assert published_values == [25.0]
+    assert device.parameters['temperature'] == 25.0
+
+
+def test_device_ignores_invalid_filter():
+    description = {
+        'name': 'greenhouse',
+        'type': 'simulated',
+        'parameters': [{'name': 'temperature', 'type': 'float', 'controllable': False, 'filter': {'averaging': 0}}]
+    }
+    device = SimulatedPeriphDev(description)
+    device.simulate_reading('temperature', 25.0)
+    assert device.parameters['temperature'] == 25.0
+
+
+def test_stream_device_flushes_on_worker():
+    listening_socket = socket.socket()
+    listening_socket.bind(('127.0.0.1', 0))
+    listening_socket.listen(1)
+    description = {
+        'name': 'greenhouse',
+        'type': 'TCP',
+        'host': '127.0.0.1',
+        'port': listening_socket.getsockname()[1],
+        'parameters': [{'name': 'temperature', 'type': 'float', 'controllable': False,
+                        'filter': {'deadband': 0.3, 'min_interval': 0.2}}]
+    }
+    io_loop = IOLoop()
+    io_loop.start()
+    device = SimpleTcpPeriphDev(description, io_loop, retry_connection_delay=60)
+    published = Event()
+    updates = []
+
+    def handle_update(device, parameter, value):
+        updates.append((value, current_thread().name))
+        if len(updates) == 2:
+            published.set()
+
+    device.parameter_updated_callback = handle_update
+    conn, _ = listening_socket.accept()
+    with conn:
+        assert conn.recv(64) == b'STATE;'
+        # The second reading is suppressed by min_interval and published by a flush
+        conn.sendall(b'PRM:temperature:21.1;PRM:temperature:25;')
+        assert published.wait(5)
+    listening_socket.close()
+    # Same as received data, flushed readings are handled by the loop's worker thread
+    assert updates == [(21.1, 'IOLoop worker'), (25.0, 'IOLoop worker')]
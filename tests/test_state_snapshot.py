@@ -0,0 +1,79 @@
+from StateSnapshot import StateSnapshotStore
+from SimplePeriphDev import SimplePeriphDev
+from SimulatedPeriphDev import SimulatedPeriphDev
+import pytest
+import json
+import time
+
+description = {
+    'name': 'greenhouse',
+    'type': 'simulated',
+    'parameters': [
+        {'name': 'temperature', 'type': 'float', 'controllable': False},
+        {'name': 'window', 'type': 'bool', 'controllable': True, 'states': ['closed', 'opened'],
+         'commands': ['Close', 'Open']}
+    ]
+}
+
+
+def write_snapshot(tmp_path, snapshot):
+    file_name = str(tmp_path / 'state_snapshot.json')
+    with open(file_name, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    return StateSnapshotStore(file_name)
+
+
+def test_save_and_load(tmp_path):
+    device = SimulatedPeriphDev(description)
+    store = StateSnapshotStore(str(tmp_path / 'state_snapshot.json'))
+    store.periph_devices = {'greenhouse': device}
+    store.save()
+    snapshot = store.load()
+    assert snapshot['greenhouse']['window'][0] == 'closed'
+    # Not connected yet
+    restored_device = SimplePeriphDev(description)
+    restored_device.restore_parameters(snapshot['greenhouse'])
+    assert restored_device.stale_parameters['window'][0] == 'closed'
+
+
+@pytest.mark.parametrize('snapshot', [
+    {'version': 1, 'devices': []},
+    {'version': 1},
+    {'version': 2, 'devices': {}},
+    [],
+    'snapshot'
+])
+def test_invalid_snapshot(tmp_path, snapshot):
+    assert write_snapshot(tmp_path, snapshot).load() == {}
+
+
+def test_invalid_entries_are_skipped(tmp_path):
+    store = write_snapshot(tmp_path, {'version': 1, 'devices': {
+        'well_and_tank': 5,
+        'greenhouse': {
+            'temperature': 5,
+            'window': ['half_opened', 1538239203.52],
+            'lights': ['on', 1538239203.52]
+        }
+    }})
+    snapshot = store.load()
+    assert list(snapshot) == ['greenhouse']
+    device = SimplePeriphDev(description)
+    device.restore_parameters(snapshot['greenhouse'])
+    assert device.stale_parameters == {}
+    device.restore_parameters({'temperature': [21.1, 1538239203.52], 'window': ['opened', 'yesterday']})
+    assert device.stale_parameters == {'temperature': (21.1, 1538239203.52)}
+
+
+def test_suppressed_reading_refreshes_time():
+    device = SimplePeriphDev(dict(description, parameters=[
+        {'name': 'temperature', 'type': 'float', 'controllable': False, 'filter': {'deadband': 0.3}}
+    ]))
+    device._handle_received_data(b'PRM:temperature:21.1;')
+    _, first_time = device.get_parameters_snapshot()['temperature']
+    time.sleep(0.01)
+    # Within the deadband, not published
+    device._handle_received_data(b'PRM:temperature:21.2;')
+    value, confirmed_time = device.get_parameters_snapshot()['temperature']
+    assert value == 21.1
+    assert confirmed_time > first_time
@@ -0,0 +1,117 @@
+from SimplePeriphDev import SimpleTcpPeriphDev
+from TrafficTrace import TrafficRecorder, TrafficReplayer, TraceEventTypes, read_trace
+from IOLoop import IOLoop
+from threading import Thread, Event
+import socket
+import json
+import time
+
+
+def serve_device_once(listening_socket, start):
+    """
+    Stands in for a TCP device. Answers the 'STATE' request with messages split across several chunks, then
+    disconnects
+    """
+    conn, _ = listening_socket.accept()
+    start.wait(5)
+    with conn:
+        assert conn.recv(64) == b'STATE;'
+        for curr_chunk in (b'PRM:temperature:2', b'1.1;PRM:window:closed;', b'PRM:temperature:21.5;'):
+            conn.sendall(curr_chunk)
+            # Making the chunks arrive separately
+            time.sleep(0.1)
+
+
+def test_tcp_trace_round_trip(tmp_path):
+    listening_socket = socket.socket()
+    listening_socket.bind(('127.0.0.1', 0))
+    listening_socket.listen(1)
+    description = {
+        'name': 'greenhouse',
+        'type': 'TCP',
+        'host': 'localhost',
+        'port': listening_socket.getsockname()[1],
+        'parameters': [
+            {'name': 'temperature', 'type': 'float', 'controllable': False},
+            {'name': 'window', 'type': 'bool', 'controllable': True, 'states': ['closed', 'opened'],
+             'commands': ['Close', 'Open']}
+        ]
+    }
+    trace_file_name = str(tmp_path / 'trace.jsonl.gz')
+    recorder = TrafficRecorder(trace_file_name, [description])
+    io_loop = IOLoop()
+    io_loop.start()
+    start = Event()
+    device_thread = Thread(target=serve_device_once, args=(listening_socket, start), daemon=True)
+    device_thread.start()
+    gone_offline = Event()
+    updates = []
+    device = SimpleTcpPeriphDev(description, io_loop, traffic_recorder=recorder, retry_connection_delay=60)
+
+    device.parameter_updated_callback = lambda device, parameter, value: updates.append((parameter, value))
+    device.gone_offline_callback = lambda device: gone_offline.set()
+    start.set()
+    assert gone_offline.wait(5)
+    device_thread.join(5)
+    listening_socket.close()
+    recorder.close()
+    assert updates == [('temperature', 21.1), ('window', 'closed'), ('temperature', 21.5)]
+
+    header, events = read_trace(trace_file_name)
+    assert header['devices'] == [description]
+    assert [curr_event[2] for curr_event in events] == [TraceEventTypes.CONNECT, TraceEventTypes.WRITE] + \
+        [TraceEventTypes.NOTIFICATION] * 3 + [TraceEventTypes.DISCONNECT]
+
+    replayer = TrafficReplayer(trace_file_name, speed=0)
+    report = replayer.run()
+    assert report['notifications'] == 3
+    assert report['raw_readings'] == 3
+    assert report['published_updates'] == 3
+    # 'STATE' request on connect
+    assert report['recorded_writes'] == 1
+    assert report['replayed_writes'] == 1
+    assert replayer.devices['greenhouse'].parameters == {'temperature': 21.5, 'window': 'closed'}
+    assert not replayer.devices['greenhouse'].online.is_set()
+
+
+def test_ble_trace_replay(tmp_path):
+    description = {
+        'name': 'greenhouse',
+        'type': 'BLE_serial_AT-09',
+        'MAC': 'E0:E5:CF:78:70:5C',
+        'parameters': [
+            {'name': 'temperature', 'type': 'float', 'controllable': False},
+            {'name': 'window', 'type': 'bool', 'controllable': True, 'states': ['closed', 'opened'],
+             'commands': ['Close', 'Open']}
+        ]
+    }
+    # Recorded after the device had connected
+    trace = [
+        {'version': 1, 'time': 1538239203.52, 'devices': [description]},
+        [0.0571, 'greenhouse', 'w', 'STATE;'],
+        [0.3102, 'greenhouse', 'n', 'PRM:temperature:2'],
+        [0.3311, 'greenhouse', 'n', '1.1;PRM:window:closed;'],
+        [1.2, 'greenhouse', 'd'],
+        [3.5, 'greenhouse', 'c'],
+        [3.61, 'greenhouse', 'n', 'PRM:window:opened;PRM:temperature:21.5;']
+    ]
+    trace_file_name = str(tmp_path / 'trace.jsonl')
+    with open(trace_file_name, 'w') as trace_file:
+        for curr_line in trace:
+            trace_file.write(json.dumps(curr_line) + '\n')
+    replayer = TrafficReplayer(trace_file_name, speed=0)
+    # The replayed device requests its state as soon as it connects
+    connection = replayer.adapters['greenhouse'].connection
+    deadline = time.monotonic() + 5
+    while connection.writes_count == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    report = replayer.run()
+    assert report['events'] == 6
+    assert report['notifications'] == 3
+    assert report['notifications_bytes'] == len('PRM:temperature:21.1;PRM:window:closed;') + \
+        len('PRM:window:opened;PRM:temperature:21.5;')
+    assert report['raw_readings'] == 4
+    assert report['published_updates'] == 4
+    assert report['recorded_writes'] == 1
+    assert report['replayed_writes'] == 1
+    assert replayer.devices['greenhouse'].parameters == {'temperature': 21.5, 'window': 'opened'}